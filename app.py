@@ -3,15 +3,34 @@ import time
 import json
 import hashlib
 import sqlite3
+import asyncio
+import unicodedata
+import zlib
+import importlib
+import multiprocessing
+import random
+import math
+import fcntl
+from array import array
+from bisect import bisect_left
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager
 from datetime import datetime
+from urllib.parse import urlsplit
 from fastapi import FastAPI, Request, HTTPException, Depends, BackgroundTasks
-from fastapi.responses import JSONResponse
-import requests
-from cachetools import TTLCache
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from pydantic import BaseModel
+from typing import List
+from limits import parse as parse_limit
+from limits.storage import Storage
+import httpx
+import orjson
+from cachetools import TTLCache, LRUCache
 from dotenv import load_dotenv
 from slowapi import Limiter, _rate_limit_exceeded_handler
 from slowapi.util import get_remote_address
-from bs4 import BeautifulSoup
 # Search temporarily using Bing API or fallback
 import logging
 
@@ -20,12 +39,261 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="Sparky Tools - Crypto + Fetch + Search [Legion Enhanced]")
+LAZY_MODULES = {}
 
-L0_CACHE = TTLCache(maxsize=500, ttl=60)
+def lazy_import(name):
+    """Import on first use, keeping the parsing and numeric libraries off the cold-start path."""
+    module = LAZY_MODULES.get(name)
+    if module is None:
+        module = LAZY_MODULES[name] = importlib.import_module(name)
+    return module
+
+# Prometheus-style registry. Every update happens on the event loop thread, so plain dicts
+# need no locks; histograms keep per-bucket counts and are made cumulative only at scrape time.
+METRICS_SAMPLE_RATE = float(os.getenv("METRICS_SAMPLE_RATE", 1))
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+CIRCUIT_OPEN_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600)
+
+METRIC_DEFS = {
+    "sparky_requests_total": ("counter", "HTTP requests by endpoint, cache outcome and status"),
+    "sparky_request_duration_seconds": ("histogram", "Request latency by endpoint and cache outcome"),
+    "sparky_upstream_requests_total": ("counter", "Upstream calls by service and HTTP status"),
+    "sparky_upstream_duration_seconds": ("histogram", "Upstream call latency by service"),
+    "sparky_circuit_transitions_total": ("counter", "Circuit breaker state changes by service"),
+    "sparky_circuit_open_seconds": ("histogram", "How long a circuit stayed open before closing"),
+    "sparky_l1_op_duration_seconds": ("histogram", "L1 SQLite operation latency, including executor queueing"),
+}
+METRICS = {name: {} for name in METRIC_DEFS}
+HISTOGRAM_BUCKETS = {"sparky_circuit_open_seconds": CIRCUIT_OPEN_BUCKETS}
+
+def inc(name, amount=1, **labels):
+    series = METRICS[name]
+    key = tuple(labels.items())
+    series[key] = series.get(key, 0) + amount
+
+def observe(name, value, **labels):
+    """Record into a histogram; with METRICS_SAMPLE_RATE < 1 only a sample is kept, weighted back up."""
+    if METRICS_SAMPLE_RATE < 1:
+        if random.random() >= METRICS_SAMPLE_RATE:
+            return
+        weight = 1 / METRICS_SAMPLE_RATE
+    else:
+        weight = 1
+    buckets = HISTOGRAM_BUCKETS.get(name, LATENCY_BUCKETS)
+    series = METRICS[name]
+    key = tuple(labels.items())
+    hist = series.get(key)
+    if hist is None:
+        # one slot per bucket, one for +Inf, then the running sum
+        hist = series[key] = [0] * (len(buckets) + 2)
+    hist[bisect_left(buckets, value)] += weight
+    hist[-1] += value * weight
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    pairs = []
+    for key, value in labels:
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{key}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+def render_metrics(snapshot):
+    """Prometheus text exposition of the registry plus scrape-time values {name: (kind, help, {labels: value})}."""
+    lines = []
+    for name, (kind, help_text) in METRIC_DEFS.items():
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+        for labels, value in METRICS[name].items():
+            if kind != "histogram":
+                lines.append(f"{name}{format_labels(labels)} {value}")
+                continue
+            buckets = HISTOGRAM_BUCKETS.get(name, LATENCY_BUCKETS)
+            cumulative = 0
+            for bound, count in zip((*buckets, "+Inf"), value):
+                cumulative += count
+                lines.append(f"{name}_bucket{format_labels(labels + (('le', bound),))} {cumulative}")
+            lines.append(f"{name}_sum{format_labels(labels)} {value[-1]}")
+            lines.append(f"{name}_count{format_labels(labels)} {cumulative}")
+    for name, (kind, help_text, series) in snapshot.items():
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+        lines += [f"{name}{format_labels(labels)} {value}" for labels, value in series.items()]
+    return "\n".join(lines) + "\n"
+
+UPSTREAM_MAX_CONNECTIONS = int(os.getenv("UPSTREAM_MAX_CONNECTIONS", 100))
+UPSTREAM_MAX_KEEPALIVE = int(os.getenv("UPSTREAM_MAX_KEEPALIVE", 20))
+UPSTREAM_KEEPALIVE_EXPIRY = float(os.getenv("UPSTREAM_KEEPALIVE_EXPIRY", 30))
+UPSTREAM_PER_HOST_LIMIT = int(os.getenv("UPSTREAM_PER_HOST_LIMIT", 10))
+
+HTTP_CLIENT = None
+HOST_SEMAPHORES = {}
+
+def init_http_client():
+    limits = httpx.Limits(
+        max_connections=UPSTREAM_MAX_CONNECTIONS,
+        max_keepalive_connections=UPSTREAM_MAX_KEEPALIVE,
+        keepalive_expiry=UPSTREAM_KEEPALIVE_EXPIRY
+    )
+    return httpx.AsyncClient(limits=limits, follow_redirects=True)
+
+@asynccontextmanager
+async def host_semaphore(url):
+    """Per-host concurrency cap. /fetch hosts are client-chosen, so an entry is dropped once nobody holds or waits on it."""
+    host = urlsplit(url).hostname or ""
+    slot = HOST_SEMAPHORES.get(host)
+    if slot is None:
+        slot = HOST_SEMAPHORES[host] = {"sem": asyncio.Semaphore(UPSTREAM_PER_HOST_LIMIT), "users": 0}
+    slot["users"] += 1
+    try:
+        async with slot["sem"]:
+            yield
+    finally:
+        slot["users"] -= 1
+        if not slot["users"]:
+            del HOST_SEMAPHORES[host]
+
+# overridable so benchmarks can point the service at local stand-ins
+COINGECKO_URL = os.getenv("COINGECKO_URL", "https://api.coingecko.com/api/v3/simple/price")
+BING_URL = os.getenv("BING_URL", "https://www.bing.com/search")
+UPSTREAM_SERVICES = {COINGECKO_URL: "coingecko", BING_URL: "search"}
+
+def record_upstream(url, start, status):
+    service = UPSTREAM_SERVICES.get(url, "fetch")
+    inc("sparky_upstream_requests_total", service=service, status=status)
+    observe("sparky_upstream_duration_seconds", time.perf_counter() - start, service=service)
+
+async def upstream_get(url, **kwargs):
+    """GET through the shared pooled client, capped per upstream host."""
+    async with host_semaphore(url):
+        start, status = time.perf_counter(), "error"
+        try:
+            r = await HTTP_CLIENT.get(url, **kwargs)
+            status = r.status_code
+            return r
+        finally:
+            record_upstream(url, start, status)
+
+async def upstream_stream(url, max_bytes, **kwargs):
+    """Streamed GET that stops reading once max_bytes have arrived. Returns (response, body, truncated)."""
+    async with host_semaphore(url):
+        start, status = time.perf_counter(), "error"
+        try:
+            async with HTTP_CLIENT.stream("GET", url, **kwargs) as r:
+                status = r.status_code
+                if r.status_code != 304:
+                    r.raise_for_status()
+                chunks, size = [], 0
+                async for chunk in r.aiter_bytes():
+                    chunks.append(chunk)
+                    size += len(chunk)
+                    if size > max_bytes:
+                        break
+                body = b"".join(chunks)
+                return r, body[:max_bytes], size > max_bytes
+        finally:
+            record_upstream(url, start, status)
+
+STARTUP = {"imports_cpu_s": None, "ready_s": None, "phases": {}}
+
+def startup_phase(name, start):
+    STARTUP["phases"][name] = round(time.perf_counter() - start, 4)
+
+@asynccontextmanager
+async def lifespan(app):
+    """Only what the first request needs runs before serving; L0 warm-up and the series snapshot load in the background."""
+    global HTTP_CLIENT, EXTRACT_POOL, L1_CACHE, L1_WRITER, SHARED_DB
+    # CPU time before the server hands over: interpreter start-up plus imports
+    STARTUP["imports_cpu_s"] = round(time.process_time(), 4)
+    started = time.perf_counter()
+    HTTP_CLIENT = init_http_client()
+    if EXTRACT_WORKERS > 0:
+        EXTRACT_POOL = new_extract_pool()
+    startup_phase("http_client", started)
+    start = time.perf_counter()
+    L1_CACHE = await run_l1(init_l1_cache)
+    L1_WRITER = await run_l1(init_l1_cache, write=True)
+    if SHARED_STATE:
+        SHARED_DB = await run_shared(init_shared_state)
+    startup_phase("sqlite_open", start)
+    prefetcher = spawn(prefetch_loop())
+    event_writer = spawn(event_writer_loop())
+    l1_writer = spawn(l1_writer_loop())
+    l1_sweeper = spawn(l1_sweeper_loop())
+    stream_poller = spawn(stream_poller_loop())
+    l0_warmer = spawn(warm_l0())
+    series_snapshotter = spawn(series_snapshot_loop())
+    shared_syncer = spawn(shared_sync_loop()) if SHARED_STATE else None
+    STARTUP["ready_s"] = round(time.perf_counter() - started, 4)
+    logger.info(f"Ready in {STARTUP['ready_s']}s ({STARTUP['imports_cpu_s']}s CPU before startup): {STARTUP['phases']}")
+    try:
+        yield
+    finally:
+        prefetcher.cancel()
+        event_writer.cancel()
+        l1_writer.cancel()
+        l1_sweeper.cancel()
+        stream_poller.cancel()
+        l0_warmer.cancel()
+        series_snapshotter.cancel()
+        if shared_syncer is not None:
+            shared_syncer.cancel()
+        # a snapshot that never finished loading must not be overwritten with partial history
+        if SERIES_RESTORED:
+            await snapshot_series(final=True)
+        await flush_events()
+        await flush_l1()
+        await run_l1(L1_WRITER.close, write=True)
+        await run_l1(L1_CACHE.close)
+        L1_CACHE = L1_WRITER = None
+        if SHARED_DB is not None:
+            try:
+                await sync_shared_state()
+            except Exception as e:
+                logger.warning(f"Final shared state sync failed: {e}")
+            await run_shared(SHARED_DB.close)
+            SHARED_DB = None
+        await HTTP_CLIENT.aclose()
+        HTTP_CLIENT = None
+        if EXTRACT_POOL is not None:
+            EXTRACT_POOL.shutdown(wait=False, cancel_futures=True)
+            EXTRACT_POOL = None
+        HOST_SEMAPHORES.clear()
+
+app = FastAPI(title="Sparky Tools - Crypto + Fetch + Search [Legion Enhanced]", lifespan=lifespan)
+
+# per-worker near cache in front of L1; keep it short when workers share L1
+L0_TTL = int(os.getenv("L0_TTL", 60))
+L0_CACHE = TTLCache(maxsize=500, ttl=L0_TTL)
+L0_ACCESS_COUNTS = Counter()
+
+L1_PATH = os.getenv("L1_PATH", "sparky_cache.db")
+L1_STALE_TTL = int(os.getenv("L1_STALE_TTL", 300))
+L1_MAX_ROWS = int(os.getenv("L1_MAX_ROWS", 50000))
+L1_MAX_BYTES = int(os.getenv("L1_MAX_BYTES", 256 * 1024 * 1024))
+L1_COMMIT_INTERVAL = float(os.getenv("L1_COMMIT_INTERVAL", 0.05))
+L1_SWEEP_INTERVAL = float(os.getenv("L1_SWEEP_INTERVAL", 60))
+# prices fetched by any worker are kept this long in L1 so every worker's series sees them
+PRICE_POINTS_TTL = int(os.getenv("PRICE_POINTS_TTL", 3600))
+
+# each L1 connection lives on its own single thread. Reads and writes are split because a group
+# commit waiting on another worker's write lock must not hold up reads, which WAL never blocks.
+L1_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sparky-l1")
+L1_WRITE_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sparky-l1-write")
+L1_PENDING = {}
+L1_COMMITTING = {}
+L1_ACCESSED = {}
+L1_POINTS = []
+L1_STATS = {"hits": 0, "stale_hits": 0, "misses": 0, "writes": 0, "commits": 0, "expired_swept": 0, "evictions": 0}
 
 def init_l1_cache():
-    conn = sqlite3.connect('sparky_cache.db', check_same_thread=False)
+    conn = sqlite3.connect(L1_PATH, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-16000")
+    conn.execute("PRAGMA mmap_size=67108864")
+    conn.execute("PRAGMA busy_timeout=5000")
+    # workers starting together would otherwise race the migration below
+    conn.execute("BEGIN IMMEDIATE")
     conn.execute('''
         CREATE TABLE IF NOT EXISTS cache (
             key TEXT PRIMARY KEY,
@@ -36,10 +304,413 @@ def init_l1_cache():
             stale_ttl_s INTEGER
         )
     ''')
+    # columns added after the original schema; older databases are migrated in place
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(cache)")}
+    for column in ("expires_at", "last_access", "size"):
+        if column not in columns:
+            conn.execute(f"ALTER TABLE cache ADD COLUMN {column} INTEGER")
+    conn.execute('''
+        UPDATE cache SET expires_at = fetched_at + ttl_s + COALESCE(stale_ttl_s, ?),
+                         last_access = fetched_at, size = LENGTH(value)
+        WHERE expires_at IS NULL
+    ''', (L1_STALE_TTL,))
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_cache_expires_at ON cache (expires_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_cache_last_access ON cache (last_access)")
+    # AUTOINCREMENT keeps ids increasing after pruning, so readers can resume from the last id seen
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS price_points (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            coin TEXT,
+            ts REAL,
+            price REAL,
+            UNIQUE (coin, ts)
+        )
+    ''')
     conn.commit()
     return conn
 
-L1_CACHE = init_l1_cache()
+# opened on the L1 threads during startup, not at import
+L1_CACHE = None
+L1_WRITER = None
+
+async def run_l1(fn, *args, write=False):
+    start = time.perf_counter()
+    try:
+        return await asyncio.get_running_loop().run_in_executor(L1_WRITE_EXECUTOR if write else L1_EXECUTOR, fn, *args)
+    finally:
+        observe("sparky_l1_op_duration_seconds", time.perf_counter() - start, op=fn.__name__)
+
+def l1_read_row(key):
+    return L1_CACHE.execute(
+        "SELECT value, etag, fetched_at, ttl_s, stale_ttl_s FROM cache WHERE key=?", (key,)
+    ).fetchone()
+
+def l1_commit(rows, accessed, points):
+    with L1_WRITER:
+        L1_WRITER.executemany(
+            "INSERT OR REPLACE INTO cache (key, value, etag, fetched_at, ttl_s, stale_ttl_s, expires_at, last_access, size) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            rows
+        )
+        L1_WRITER.executemany("UPDATE cache SET last_access=? WHERE key=?", [(ts, key) for key, ts in accessed.items()])
+        L1_WRITER.executemany("INSERT OR IGNORE INTO price_points (coin, ts, price) VALUES (?, ?, ?)", points)
+
+def l1_sweep():
+    """Drop rows past their stale window, then evict least recently used rows over the caps."""
+    now = int(time.time())
+    with L1_WRITER:
+        expired = L1_WRITER.execute("DELETE FROM cache WHERE expires_at < ?", (now,)).rowcount
+        L1_WRITER.execute("DELETE FROM price_points WHERE ts < ?", (now - PRICE_POINTS_TTL,))
+    evicted = 0
+    while True:
+        rows, size = L1_WRITER.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache").fetchone()
+        if rows <= L1_MAX_ROWS and size <= L1_MAX_BYTES:
+            break
+        batch = rows - L1_MAX_ROWS if rows > L1_MAX_ROWS else 100
+        with L1_WRITER:
+            evicted += L1_WRITER.execute(
+                "DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY last_access LIMIT ?)", (batch,)
+            ).rowcount
+    return expired, evicted
+
+async def flush_l1():
+    """Group commit: every pending write and access-time update goes in one transaction."""
+    global L1_PENDING, L1_COMMITTING, L1_ACCESSED, L1_POINTS
+    if not L1_PENDING and not L1_ACCESSED and not L1_POINTS:
+        return
+    L1_COMMITTING, L1_PENDING = L1_PENDING, {}
+    accessed, L1_ACCESSED = L1_ACCESSED, {}
+    points, L1_POINTS = L1_POINTS, []
+    try:
+        await run_l1(l1_commit, list(L1_COMMITTING.values()), accessed, points, write=True)
+        L1_STATS["commits"] += 1
+    except Exception:
+        # back in the queue for the next commit, without overwriting anything written since
+        for key, row in L1_COMMITTING.items():
+            L1_PENDING.setdefault(key, row)
+        for key, ts in accessed.items():
+            L1_ACCESSED.setdefault(key, ts)
+        L1_POINTS[:0] = points
+        raise
+    finally:
+        L1_COMMITTING = {}
+
+async def l1_writer_loop():
+    while True:
+        await asyncio.sleep(L1_COMMIT_INTERVAL)
+        try:
+            await flush_l1()
+        except Exception as e:
+            logger.warning(f"L1 commit failed: {e}")
+
+async def l1_sweeper_loop():
+    while True:
+        await asyncio.sleep(L1_SWEEP_INTERVAL)
+        try:
+            expired, evicted = await run_l1(l1_sweep, write=True)
+            L1_STATS["expired_swept"] += expired
+            L1_STATS["evictions"] += evicted
+            if SHARED_DB is not None:
+                await run_shared(shared_sweep)
+        except Exception as e:
+            logger.warning(f"L1 sweep failed: {e}")
+
+L0_WARMUP_ENTRIES = int(os.getenv("L0_WARMUP_ENTRIES", 500))
+
+def l1_recent_rows(limit):
+    """Most recently used rows still inside their TTL, newest first, walking idx_cache_last_access."""
+    return L1_CACHE.execute(
+        "SELECT key, value FROM cache WHERE fetched_at + ttl_s > ? ORDER BY last_access DESC LIMIT ?",
+        (int(time.time()), limit)
+    ).fetchall()
+
+async def warm_l0():
+    """After a cold start, load the hottest fresh L1 entries into L0 so they are served from memory."""
+    start = time.perf_counter()
+    rows = await run_l1(l1_recent_rows, min(L0_WARMUP_ENTRIES, L0_CACHE.maxsize))
+    loaded = 0
+    # oldest first, so if L0 fills up it is the least recently used rows that get evicted
+    for i, (key, value) in enumerate(reversed(rows)):
+        kind, _, name = key.removeprefix("l1_").partition("_")
+        l0_key = f"l0_{kind}_{name}"
+        if l0_key in L0_CACHE:
+            continue
+        if kind == "price":
+            L0_CACHE[l0_key] = json.loads(value)
+        elif kind == "fetch":
+            L0_CACHE[l0_key] = encode_entry(cached_payload(json.loads(value)), {"url": name, "endpoint": "fetch"})
+        elif kind == "search":
+            L0_CACHE[l0_key] = encode_entry(cached_payload(json.loads(value)), {"q": name, "endpoint": "search"})
+        else:
+            continue
+        loaded += 1
+        if i % 50 == 49:
+            # encoding is CPU work; let requests that arrive meanwhile run
+            await asyncio.sleep(0)
+    startup_phase("l0_warmup", start)
+    STARTUP["l0_warmed_entries"] = loaded
+
+# With several workers (uvicorn --workers N) the L1 database doubles as the host-wide shared
+# state: rate-limit buckets, circuit breakers, the CoinGecko budget and upstream leases live in
+# it, and L1 itself is the shared hot tier behind each worker's small L0. SQLite is never touched
+# on the event loop: counters and breakers are answered from this worker's copy and reconciled
+# by shared_sync_loop, and leases are taken on SHARED_EXECUTOR. Off for a single worker, where
+# leases and shared price points would only cost a SQLite round trip per miss.
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", 1))
+SHARED_STATE = os.getenv("SHARED_STATE", "1" if WEB_CONCURRENCY > 1 else "0") == "1"
+SHARED_SYNC_INTERVAL = float(os.getenv("SHARED_SYNC_INTERVAL", 0.5))
+SHARED_LOCK_TIMEOUT_MS = int(os.getenv("SHARED_LOCK_TIMEOUT_MS", 100))
+LEASE_TTL = float(os.getenv("LEASE_TTL", 15))
+LEASE_WAIT = float(os.getenv("LEASE_WAIT", 5))
+LEASE_POLL = float(os.getenv("LEASE_POLL", 0.05))
+# a successful lease is held this much longer so our group commit lands in L1 before others look
+LEASE_LINGER = L1_COMMIT_INTERVAL + 1
+
+WORKER_ID = f"{os.getpid()}-{os.urandom(4).hex()}"
+SHARED_STATS = {"leases_won": 0, "leases_waited": 0, "served_from_peers": 0, "lease_timeouts": 0, "syncs": 0, "sync_errors": 0}
+
+SHARED_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sparky-shared")
+SHARED_COUNTERS = {}
+CIRCUIT_PENDING = {}
+
+def init_shared_state():
+    # only ever used from SHARED_EXECUTOR; the short busy timeout bounds how long a cache miss can
+    # queue behind another process's lock before it gives up on coordinating and fetches itself
+    conn = sqlite3.connect(L1_PATH, check_same_thread=False, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA busy_timeout={SHARED_LOCK_TIMEOUT_MS}")
+    conn.execute("CREATE TABLE IF NOT EXISTS counters (key TEXT PRIMARY KEY, value INTEGER, expires_at REAL)")
+    conn.execute("CREATE TABLE IF NOT EXISTS circuits (service TEXT PRIMARY KEY, failures INTEGER, last_failure REAL, open INTEGER)")
+    conn.execute("CREATE TABLE IF NOT EXISTS leases (key TEXT PRIMARY KEY, owner TEXT, expires_at REAL)")
+    return conn
+
+SHARED_DB = None
+
+async def run_shared(fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(SHARED_EXECUTOR, fn, *args)
+
+class SharedLimitStorage(Storage):
+    """limits storage answered from this worker's counters; shared_sync_loop folds in the other workers' hits."""
+    STORAGE_SCHEME = ["sparky-shared"]
+    
+    @property
+    def base_exceptions(self):
+        return sqlite3.Error
+    
+    def incr(self, key, expiry, amount=1):
+        now = time.time()
+        counter = SHARED_COUNTERS.get(key)
+        if counter is None or counter["expires_at"] <= now:
+            counter = SHARED_COUNTERS[key] = {"shared": 0, "delta": 0, "expires_at": now + expiry, "expiry": expiry}
+        counter["delta"] += amount
+        return counter["shared"] + counter["delta"]
+    
+    def get(self, key):
+        counter = SHARED_COUNTERS.get(key)
+        if counter is None or counter["expires_at"] <= time.time():
+            return 0
+        return counter["shared"] + counter["delta"]
+    
+    def get_expiry(self, key):
+        counter = SHARED_COUNTERS.get(key)
+        return counter["expires_at"] if counter else time.time()
+    
+    def check(self):
+        return True
+    
+    def reset(self):
+        count = len(SHARED_COUNTERS)
+        SHARED_COUNTERS.clear()
+        return count
+    
+    def clear(self, key):
+        SHARED_COUNTERS.pop(key, None)
+
+def shared_sync(counters, watched, circuits):
+    """Runs on SHARED_EXECUTOR: push this worker's counter and breaker changes in one transaction,
+    returning the host-wide totals for every counter this worker uses and every breaker."""
+    now = time.time()
+    totals = {}
+    # an idle worker only reads, so it must not take the write lock from other workers' L1 commits
+    SHARED_DB.execute("BEGIN IMMEDIATE" if counters or circuits else "BEGIN")
+    try:
+        for key, delta, expiry in counters:
+            totals[key] = SHARED_DB.execute('''
+                INSERT INTO counters (key, value, expires_at) VALUES (?, ?, ?)
+                ON CONFLICT(key) DO UPDATE SET
+                    value = CASE WHEN expires_at <= ? THEN excluded.value ELSE value + excluded.value END,
+                    expires_at = CASE WHEN expires_at <= ? THEN excluded.expires_at ELSE expires_at END
+                RETURNING value, expires_at
+            ''', (key, delta, now + expiry, now, now)).fetchone()
+        for i in range(0, len(watched), 500):
+            chunk = watched[i:i + 500]
+            totals.update((row[0], row[1:]) for row in SHARED_DB.execute(
+                f"SELECT key, value, expires_at FROM counters WHERE expires_at > ? AND key IN ({','.join('?' * len(chunk))})",
+                (now, *chunk)))
+        for service, pending in circuits.items():
+            if pending["reset"]:
+                SHARED_DB.execute("UPDATE circuits SET failures=0, open=0 WHERE service=?", (service,))
+            if pending["failures"]:
+                SHARED_DB.execute('''
+                    INSERT INTO circuits (service, failures, last_failure, open) VALUES (?, ?, ?, ?)
+                    ON CONFLICT(service) DO UPDATE SET
+                        failures = failures + excluded.failures,
+                        last_failure = MAX(last_failure, excluded.last_failure),
+                        open = open OR failures + excluded.failures >= ?
+                ''', (service, pending["failures"], pending["last_failure"],
+                      int(pending["failures"] >= CIRCUIT_THRESHOLD), CIRCUIT_THRESHOLD))
+        breakers = {row[0]: row[1:] for row in SHARED_DB.execute("SELECT service, failures, last_failure, open FROM circuits")}
+        SHARED_DB.execute("COMMIT")
+    except Exception:
+        SHARED_DB.execute("ROLLBACK")
+        raise
+    return totals, breakers
+
+async def sync_shared_state():
+    global CIRCUIT_PENDING
+    now = time.time()
+    counters, watched = [], []
+    for key, counter in list(SHARED_COUNTERS.items()):
+        if counter["expires_at"] <= now:
+            del SHARED_COUNTERS[key]
+        elif counter["delta"]:
+            counters.append((key, counter["delta"], counter["expiry"]))
+            counter["delta"] = 0
+        else:
+            # no hits here since the last sync, but the other workers may have used it
+            watched.append(key)
+    circuits, CIRCUIT_PENDING = CIRCUIT_PENDING, {}
+    try:
+        totals, breakers = await run_shared(shared_sync, counters, watched, circuits)
+    except Exception:
+        # nothing was pushed; keep the changes for the next pass
+        for key, delta, _ in counters:
+            if key in SHARED_COUNTERS:
+                SHARED_COUNTERS[key]["delta"] += delta
+        for service, pending in circuits.items():
+            newer = CIRCUIT_PENDING.get(service)
+            if newer is None:
+                CIRCUIT_PENDING[service] = pending
+            elif not newer["reset"]:
+                newer["failures"] += pending["failures"]
+                newer["reset"] = pending["reset"]
+        raise
+    now = time.time()
+    for key, (value, expires_at) in totals.items():
+        counter = SHARED_COUNTERS.get(key)
+        if counter is not None and expires_at > now:
+            counter["shared"], counter["expires_at"] = value, expires_at
+    for service, (failures, last_failure, is_open) in breakers.items():
+        if service not in CIRCUIT_STATE:
+            continue
+        pending = CIRCUIT_PENDING.get(service)
+        if pending and pending["reset"]:
+            # a success recorded since the push wins until it is pushed itself
+            continue
+        if pending:
+            failures += pending["failures"]
+            last_failure = max(last_failure, pending["last_failure"])
+            is_open = is_open or failures >= CIRCUIT_THRESHOLD
+        state = CIRCUIT_STATE[service]
+        if bool(is_open) != state["open"]:
+            record_transition(service, bool(is_open))
+        state["failures"], state["last_failure"], state["open"] = failures, last_failure, bool(is_open)
+
+async def shared_sync_loop():
+    while True:
+        await asyncio.sleep(SHARED_SYNC_INTERVAL)
+        try:
+            await sync_shared_state()
+            await sync_series()
+            SHARED_STATS["syncs"] += 1
+        except Exception as e:
+            SHARED_STATS["sync_errors"] += 1
+            logger.warning(f"Shared state sync failed: {e}")
+
+def claim_leases(keys):
+    now = time.time()
+    owned = set()
+    for key in keys:
+        row = SHARED_DB.execute('''
+            INSERT INTO leases (key, owner, expires_at) VALUES (?, ?, ?)
+            ON CONFLICT(key) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at
+            WHERE leases.expires_at <= ?
+            RETURNING key
+        ''', (key, WORKER_ID, now + LEASE_TTL, now)).fetchone()
+        if row:
+            owned.add(key)
+    return owned
+
+def expire_leases(keys, expires_at):
+    SHARED_DB.executemany("UPDATE leases SET expires_at=? WHERE key=? AND owner=?",
+                          [(expires_at, key, WORKER_ID) for key in keys])
+
+def count_leases(keys):
+    now = time.time()
+    return sum(1 for key in keys if SHARED_DB.execute("SELECT 1 FROM leases WHERE key=? AND expires_at > ?", (key, now)).fetchone())
+
+async def acquire_leases(keys):
+    """Claim upstream refreshes across workers; returns the subset of keys this worker now holds."""
+    keys = list(keys)
+    if SHARED_DB is None:
+        return set(keys)
+    try:
+        owned = await run_shared(claim_leases, keys)
+    except sqlite3.Error as e:
+        # cannot coordinate right now; fetching ourselves is better than waiting on nobody
+        logger.warning(f"Lease claim failed: {e}")
+        return set(keys)
+    SHARED_STATS["leases_won"] += len(owned)
+    return owned
+
+async def release_leases(keys, linger=0):
+    if SHARED_DB is None or not keys:
+        return
+    try:
+        await run_shared(expire_leases, list(keys), time.time() + linger)
+    except sqlite3.Error as e:
+        logger.warning(f"Lease release failed: {e}")
+
+async def leases_held(keys):
+    try:
+        return await run_shared(count_leases, list(keys)) > 0
+    except sqlite3.Error:
+        return False
+
+async def wait_for_peers(keys, read):
+    """Poll L1 while another worker holds the leases; None if it failed or took longer than LEASE_WAIT."""
+    SHARED_STATS["leases_waited"] += 1
+    deadline = time.time() + LEASE_WAIT
+    while time.time() < deadline:
+        await asyncio.sleep(LEASE_POLL)
+        result = await read()
+        if result is not None:
+            SHARED_STATS["served_from_peers"] += 1
+            return result
+        if not await leases_held(keys):
+            return None
+    SHARED_STATS["lease_timeouts"] += 1
+    return None
+
+async def shared_flight(key, fetch, read):
+    """Cross-worker single-flight: the lease holder calls upstream, the others pick its result up from L1."""
+    if not await acquire_leases([key]):
+        result = await wait_for_peers([key], read)
+        if result is not None:
+            return result
+    try:
+        result = await fetch()
+    except Exception:
+        spawn(release_leases([key]))
+        raise
+    spawn(release_leases([key], linger=LEASE_LINGER))
+    return result
+
+def shared_sweep():
+    now = time.time()
+    SHARED_DB.execute("DELETE FROM counters WHERE expires_at < ?", (now,))
+    SHARED_DB.execute("DELETE FROM leases WHERE expires_at < ?", (now,))
 
 CIRCUIT_STATE = {
     "coingecko": {"failures": 0, "last_failure": 0, "open": False},
@@ -48,71 +719,271 @@ CIRCUIT_STATE = {
 }
 CIRCUIT_THRESHOLD = 5
 CIRCUIT_TIMEOUT = 300
+CIRCUIT_OPENED_AT = {}
+
+EVENT_LOG_PATH = os.getenv("EVENT_LOG_PATH", "sparky_events.jsonl")
+EVENT_QUEUE_MAX = int(os.getenv("EVENT_QUEUE_MAX", 10000))
+EVENT_QUEUE_POLICY = os.getenv("EVENT_QUEUE_POLICY", "drop_oldest")  # or drop_newest
+EVENT_BATCH_SIZE = int(os.getenv("EVENT_BATCH_SIZE", 500))
+EVENT_FLUSH_INTERVAL = float(os.getenv("EVENT_FLUSH_INTERVAL", 0.5))
+EVENT_ROTATE_BYTES = int(os.getenv("EVENT_ROTATE_BYTES", 50 * 1024 * 1024))
+EVENT_ROTATE_SECONDS = int(os.getenv("EVENT_ROTATE_SECONDS", 86400))
+EVENT_BACKUPS = int(os.getenv("EVENT_BACKUPS", 5))
+
+EVENT_QUEUE = deque()
+EVENT_LOG_STATE = {"opened_at": time.time(), "written": 0, "dropped": 0, "rotations": 0}
 
 def log_event(event_type, run_id, data):
+    """Queue an event for the background writer; never touches the file on the request path."""
     event = {
-        "event_id": hashlib.sha256(f"{time.time()}{run_id}".encode()).hexdigest()[:16],
+        "event_id": os.urandom(8).hex(),
         "run_id": run_id,
         "timestamp": datetime.utcnow().isoformat(),
         "type": event_type,
         "data": data
     }
-    with open('sparky_events.jsonl', 'a') as f:
-        f.write(json.dumps(event) + '\n')
+    if len(EVENT_QUEUE) >= EVENT_QUEUE_MAX:
+        EVENT_LOG_STATE["dropped"] += 1
+        if EVENT_QUEUE_POLICY == "drop_newest":
+            return event
+        EVENT_QUEUE.popleft()
+    EVENT_QUEUE.append(event)
     return event
 
+def rotate_event_log():
+    for i in range(EVENT_BACKUPS - 1, 0, -1):
+        if os.path.exists(f"{EVENT_LOG_PATH}.{i}"):
+            os.replace(f"{EVENT_LOG_PATH}.{i}", f"{EVENT_LOG_PATH}.{i + 1}")
+    if EVENT_BACKUPS > 0:
+        os.replace(EVENT_LOG_PATH, f"{EVENT_LOG_PATH}.1")
+    else:
+        os.remove(EVENT_LOG_PATH)
+    EVENT_LOG_STATE["opened_at"] = time.time()
+    EVENT_LOG_STATE["rotations"] += 1
+
+def write_event_batch(batch):
+    data = "".join(json.dumps(event) + '\n' for event in batch).encode()
+    # workers share the log: the lock makes size check, rotation and append one step across processes,
+    # and the lock file holds the time of the last rotation by any of them
+    with open(f"{EVENT_LOG_PATH}.lock", "a+") as lock:
+        fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+        lock.seek(0)
+        opened_at = float(lock.read() or EVENT_LOG_STATE["opened_at"])
+        try:
+            size = os.path.getsize(EVENT_LOG_PATH)
+        except FileNotFoundError:
+            size = 0
+        if size and (size >= EVENT_ROTATE_BYTES or time.time() - opened_at >= EVENT_ROTATE_SECONDS):
+            rotate_event_log()
+            lock.truncate(0)
+            lock.write(str(EVENT_LOG_STATE["opened_at"]))
+            lock.flush()
+        # one O_APPEND write per batch, so lines from several workers never interleave mid-line
+        fd = os.open(EVENT_LOG_PATH, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+    EVENT_LOG_STATE["written"] += len(batch)
+
+async def flush_events():
+    while EVENT_QUEUE:
+        batch = [EVENT_QUEUE.popleft() for _ in range(min(EVENT_BATCH_SIZE, len(EVENT_QUEUE)))]
+        try:
+            await asyncio.to_thread(write_event_batch, batch)
+        except Exception:
+            # back to the front of the queue so the next flush retries it in order
+            EVENT_QUEUE.extendleft(reversed(batch))
+            raise
+
+async def event_writer_loop():
+    while True:
+        await asyncio.sleep(EVENT_FLUSH_INTERVAL)
+        try:
+            await flush_events()
+        except Exception as e:
+            logger.warning(f"Event log flush failed: {e}")
+
+def tail_events(limit, event_type=None, run_id=None, block_size=65536):
+    """Newest-first scan from the end of the log, stopping once limit matches are found."""
+    events = []
+    try:
+        f = open(EVENT_LOG_PATH, 'rb')
+    except FileNotFoundError:
+        return events
+    with f:
+        pos = f.seek(0, os.SEEK_END)
+        tail = b""
+        while pos > 0 and len(events) < limit:
+            step = min(block_size, pos)
+            pos -= step
+            f.seek(pos)
+            lines = (f.read(step) + tail).split(b"\n")
+            # the first piece may be a partial line unless we reached the start of the file
+            tail = lines.pop(0) if pos > 0 else b""
+            for line in reversed(lines):
+                if not line:
+                    continue
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    continue
+                if (event_type is None or event["type"] == event_type) and (run_id is None or event["run_id"] == run_id):
+                    events.append(event)
+                    if len(events) >= limit:
+                        break
+    events.reverse()
+    return events
+
 def sha256_hash(data):
     return hashlib.sha256(json.dumps(data, sort_keys=True).encode()).hexdigest()
 
-def l1_get(key):
-    cursor = L1_CACHE.execute("SELECT value, fetched_at, ttl_s FROM cache WHERE key=?", (key,))
-    row = cursor.fetchone()
+async def l1_get(key):
+    pending = L1_PENDING.get(key) or L1_COMMITTING.get(key)
+    row = pending[1:6] if pending else await run_l1(l1_read_row, key)
     if row:
-        value, fetched_at, ttl_s = row
+        value, etag, fetched_at, ttl_s, stale_ttl_s = row
         now = int(time.time())
         if now < fetched_at + ttl_s:
+            L1_STATS["hits"] += 1
+            L1_ACCESSED[key] = now
             return json.loads(value)
-        elif now < fetched_at + ttl_s + 300:
+        elif now < fetched_at + ttl_s + (stale_ttl_s if stale_ttl_s is not None else L1_STALE_TTL):
+            L1_STATS["stale_hits"] += 1
+            L1_ACCESSED[key] = now
             return {**json.loads(value), "_stale": True}
+    L1_STATS["misses"] += 1
     return None
 
-def l1_set(key, value, ttl=300):
-    L1_CACHE.execute(
-        "INSERT OR REPLACE INTO cache (key, value, fetched_at, ttl_s, stale_ttl_s) VALUES (?, ?, ?, ?, ?)",
-        (key, json.dumps(value), int(time.time()), ttl, 300)
-    )
-    L1_CACHE.commit()
+def l1_set(key, value, ttl=300, etag=None):
+    """Queue a write for the next group commit; readers see it immediately via L1_PENDING."""
+    now = int(time.time())
+    data = json.dumps(value)
+    L1_PENDING[key] = (key, data, etag, now, ttl, L1_STALE_TTL, now + ttl + L1_STALE_TTL, now, len(data))
+    L1_STATS["writes"] += 1
+
+def record_transition(service, opened):
+    """Count a breaker opening or closing as this worker sees it, whether it happened here or arrived by shared sync."""
+    now = time.time()
+    if opened:
+        CIRCUIT_OPENED_AT[service] = now
+    else:
+        # a breaker that was already open when this worker started has no open time; its last failure is close enough
+        opened_at = CIRCUIT_OPENED_AT.pop(service, CIRCUIT_STATE[service]["last_failure"])
+        observe("sparky_circuit_open_seconds", now - opened_at, service=service)
+    inc("sparky_circuit_transitions_total", service=service, to="open" if opened else "closed")
 
 def check_circuit(service):
     state = CIRCUIT_STATE[service]
     if state["open"]:
         if time.time() - state["last_failure"] > CIRCUIT_TIMEOUT:
-            state["open"] = False
-            state["failures"] = 0
+            record_success(service)
         else:
             return False
     return True
 
 def record_failure(service):
     state = CIRCUIT_STATE[service]
+    now = time.time()
+    was_open = state["open"]
     state["failures"] += 1
-    state["last_failure"] = time.time()
+    state["last_failure"] = now
     if state["failures"] >= CIRCUIT_THRESHOLD:
         state["open"] = True
+    if SHARED_DB is not None:
+        pending = CIRCUIT_PENDING.setdefault(service, {"failures": 0, "last_failure": 0, "reset": False})
+        pending["failures"] += 1
+        pending["last_failure"] = now
+    if state["open"] and not was_open:
+        record_transition(service, True)
 
-def generate_attestation(run_id, inputs, outputs, tool_version, policy_mode="STRICT"):
+def record_success(service):
+    state = CIRCUIT_STATE[service]
+    if state["open"]:
+        record_transition(service, False)
+    if state["failures"] or state["open"]:
+        state["failures"], state["open"] = 0, False
+        if SHARED_DB is not None:
+            # supersedes any failures not yet pushed
+            CIRCUIT_PENDING[service] = {"failures": 0, "last_failure": 0, "reset": True}
+
+def attestation_from_hashes(run_id, inputs_hash, outputs_hash, tool_version, policy_mode="STRICT"):
     return {
         "run_id": run_id,
         "timestamp": datetime.utcnow().isoformat(),
         "policy_mode": policy_mode,
-        "inputs_hash": sha256_hash(inputs),
-        "outputs_hash": sha256_hash(outputs),
+        "inputs_hash": inputs_hash,
+        "outputs_hash": outputs_hash,
         "tool_version": tool_version,
         "cost": {"usd": 0.0, "tokens": 0},
         "evidence_refs": [],
         "signature": f"sig:sparky_{sha256_hash(run_id)[:16]}"
     }
 
+def generate_attestation(run_id, inputs, outputs, tool_version, policy_mode="STRICT"):
+    return attestation_from_hashes(run_id, sha256_hash(inputs), sha256_hash(outputs), tool_version, policy_mode)
+
+GZIP_PRECOMPRESS = os.getenv("GZIP_PRECOMPRESS", "0") == "1"
+GZIP_MIN_BYTES = int(os.getenv("GZIP_MIN_BYTES", 1024))
+
+# per-request fields; everything else in a cached result is encoded once, at write time
+RESPONSE_FIELDS = ("_cache", "_run_id", "attestation", "_stale", "_circuit_open")
+
+def cached_payload(result):
+    return {k: v for k, v in result.items() if k not in RESPONSE_FIELDS}
+
+def encode_entry(payload, inputs):
+    """Canonical payload bytes plus the hashes attestations need, computed once per cache write."""
+    body = orjson.dumps(payload, option=orjson.OPT_SORT_KEYS)
+    entry = {
+        "payload": payload,
+        "body": body,
+        "hash": hashlib.sha256(body).hexdigest(),
+        "inputs_hash": sha256_hash(inputs),
+        "gzip": None
+    }
+    if GZIP_PRECOMPRESS and len(body) >= GZIP_MIN_BYTES:
+        # compress everything but the closing brace; per-request fields are appended to a copy of the stream
+        gz = zlib.compressobj(6, zlib.DEFLATED, 16 + 12, 4)
+        entry["gzip"] = (gz.compress(body[:-1]) + gz.flush(zlib.Z_SYNC_FLUSH), gz)
+    return entry
+
+def render_body(entry, fields):
+    tail = orjson.dumps(fields)
+    sep = b"," if len(entry["body"]) > 2 and len(tail) > 2 else b""
+    return entry["body"][:-1] + sep + tail[1:]
+
+def accepts_gzip(request):
+    """Accept-Encoding allows gzip: named with q > 0, or covered by * when gzip is not named."""
+    weights = {}
+    for part in request.headers.get("accept-encoding", "").lower().split(","):
+        coding, _, params = part.partition(";")
+        q = 1.0
+        for param in params.split(";"):
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        weights[coding.strip()] = q
+    return weights.get("gzip", weights.get("*", 0)) > 0
+
+def render_response(request, entry, fields, headers=None):
+    """Splice per-request fields into the pre-encoded payload instead of re-serializing it."""
+    headers = dict(headers or {})
+    if entry["gzip"] is None:
+        return Response(content=render_body(entry, fields), media_type="application/json", headers=headers)
+    headers["Vary"] = "Accept-Encoding"
+    if not accepts_gzip(request):
+        return Response(content=render_body(entry, fields), media_type="application/json", headers=headers)
+    tail = orjson.dumps(fields)
+    prefix, gz = entry["gzip"]
+    gz = gz.copy()
+    content = prefix + gz.compress((b"," if len(tail) > 2 else b"") + tail[1:]) + gz.flush()
+    headers["Content-Encoding"] = "gzip"
+    return Response(content=content, media_type="application/json", headers=headers)
+
 def generate_next_actions(endpoint, coin=None, url=None, query=None):
     actions = []
     if endpoint == "prices":
@@ -148,196 +1019,1131 @@ async def log_request_source(request: Request, call_next):
     
     return await call_next(request)
 
-limiter = Limiter(key_func=get_remote_address)
+class RequestMetricsMiddleware:
+    """Latency to the response start per route template and cache outcome, as plain ASGI so the body
+    streams straight through; tool_response tags the outcome on request.state (scope["state"])."""
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        start = time.perf_counter()
+        recorded = False
+        
+        def record(status):
+            nonlocal recorded
+            recorded = True
+            route = scope.get("route")
+            endpoint = route.path if route is not None else "unmatched"
+            cache = scope.get("state", {}).get("cache_outcome", "none")
+            inc("sparky_requests_total", endpoint=endpoint, cache=cache, status=status)
+            observe("sparky_request_duration_seconds", time.perf_counter() - start, endpoint=endpoint, cache=cache)
+        
+        async def send_with_metrics(message):
+            if message["type"] == "http.response.start" and not recorded:
+                record(message["status"])
+            await send(message)
+        
+        try:
+            await self.app(scope, receive, send_with_metrics)
+        except Exception:
+            if not recorded:
+                record(500)
+            raise
+
+app.add_middleware(RequestMetricsMiddleware)
+
+limiter = Limiter(
+    key_func=get_remote_address,
+    storage_uri="sparky-shared://" if SHARED_STATE else "memory://"
+)
 app.state.limiter = limiter
 app.add_exception_handler(429, _rate_limit_exceeded_handler)
 
 PORT = int(os.getenv("PORT", 8000))
 TOOL_VERSION = "v2.0-legion"
+DEFAULT_COINS = "bitcoin,ethereum,solana"
 
-@app.get("/prices")
-@limiter.limit("60/minute")
-async def get_prices(request: Request, coins: str = "bitcoin,ethereum,solana"):
-    run_id = f"price_{int(time.time()*1000)}"
-    inputs = {"coins": coins, "endpoint": "prices"}
+# per-client limits; scopes are shared so /batch sub-calls draw from the same buckets
+RATE_LIMITS = {
+    "prices": os.getenv("RATE_LIMIT_PRICES", "60/minute"),
+    "fetch": os.getenv("RATE_LIMIT_FETCH", "30/minute"),
+    "search": os.getenv("RATE_LIMIT_SEARCH", "20/minute")
+}
+
+PRICE_TTL = int(os.getenv("PRICE_TTL", 300))
+
+def parse_coins(coins):
+    """Normalize a coins query into an ordered, de-duplicated list of CoinGecko IDs."""
+    ids = []
+    for coin in coins.split(","):
+        coin = coin.strip().lower()
+        if coin and coin not in ids:
+            ids.append(coin)
+    return ids
+
+async def get_cached_coin(coin):
+    """Per-coin lookup: returns (entry, layer) where layer is L0, L1 or STALE."""
+    l0_key = f"l0_price_{coin}"
+    L0_ACCESS_COUNTS[l0_key] += 1
+    if l0_key in L0_CACHE:
+        return L0_CACHE[l0_key], "L0"
+    cached = await l1_get(f"l1_price_{coin}")
+    if cached and not cached.get("_stale"):
+        L0_CACHE[l0_key] = cached
+        return cached, "L1"
+    if cached:
+        return cached, "STALE"
+    return None, None
+
+def set_cached_coin(coin, data, fetched_at):
+    # data is None for IDs CoinGecko does not know, so typos are not refetched every call
+    entry = {"data": data, "fetched_at": fetched_at}
+    if data and data.get("usd") is not None:
+        record_price(coin, fetched_at, data["usd"])
+        if SHARED_STATE:
+            L1_POINTS.append((coin, fetched_at, data["usd"]))
+    L0_CACHE[f"l0_price_{coin}"] = entry
+    l1_set(f"l1_price_{coin}", entry, ttl=PRICE_TTL)
+    return entry
+
+async def fetch_coin_prices(ids):
+    """One simple/price call for the given IDs; stores and returns per-coin entries."""
+    r = await upstream_get(
+        COINGECKO_URL,
+        params={"ids": ",".join(ids), "vs_currencies": "usd", "include_24hr_change": "true"},
+        timeout=5
+    )
+    r.raise_for_status()
+    data = r.json()
+    fetched_at = int(time.time())
+    return {coin: set_cached_coin(coin, data.get(coin), fetched_at) for coin in ids}
+
+COALESCE_WINDOW_MS = float(os.getenv("COALESCE_WINDOW_MS", 5))
+COALESCE_MAX_IDS = int(os.getenv("COALESCE_MAX_IDS", 200))
+COINGECKO_CALLS_PER_MINUTE = int(os.getenv("COINGECKO_CALLS_PER_MINUTE", 25))
+
+PRICE_INFLIGHT = {}
+PENDING_PRICE_BATCH = None
+BACKGROUND_TASKS = set()
+# drawn from the limiter's storage, so in multi-worker mode the budget is per host, not per worker
+UPSTREAM_BUDGET = parse_limit(f"{COINGECKO_CALLS_PER_MINUTE}/minute")
+COALESCE_STATS = {"upstream_calls": 0, "requests_served": 0, "last_batch_requests": 0, "last_batch_ids": 0}
+
+def spawn(coro):
+    task = asyncio.create_task(coro)
+    BACKGROUND_TASKS.add(task)
+    task.add_done_callback(BACKGROUND_TASKS.discard)
+    return task
+
+def upstream_budget_available():
+    return limiter.limiter.test(UPSTREAM_BUDGET, "upstream", "coingecko")
+
+def upstream_budget_used():
+    _, remaining = limiter.limiter.get_window_stats(UPSTREAM_BUDGET, "upstream", "coingecko")
+    return COINGECKO_CALLS_PER_MINUTE - remaining
+
+async def fetch_prices_upstream(ids):
+    limiter.limiter.hit(UPSTREAM_BUDGET, "upstream", "coingecko")
+    COALESCE_STATS["upstream_calls"] += 1
+    return await fetch_coin_prices(ids)
+
+async def read_peer_prices(coins):
+    """Fresh L1 entries for every coin, or None while some are still being fetched by another worker."""
+    entries = {}
+    for coin in coins:
+        cached = await l1_get(f"l1_price_{coin}")
+        if not cached or cached.get("_stale"):
+            return None
+        entries[coin] = cached
+    for coin, entry in entries.items():
+        L0_CACHE[f"l0_price_{coin}"] = entry
+        if entry["data"] and entry["data"].get("usd") is not None:
+            record_price(coin, entry["fetched_at"], entry["data"]["usd"])
+    return entries
+
+async def fetch_prices_shared(ids):
+    """Call CoinGecko only for coins this worker holds the lease on; the rest arrive via L1."""
+    keys = {coin: f"price:{coin}" for coin in ids}
+    owned = await acquire_leases(keys.values())
+    mine = [coin for coin in ids if keys[coin] in owned]
+    entries = {}
+    if mine:
+        try:
+            entries = await fetch_prices_upstream(mine)
+        except Exception:
+            spawn(release_leases(owned))
+            raise
+        spawn(release_leases(owned, linger=LEASE_LINGER))
+    rest = [coin for coin in ids if coin not in entries]
+    if rest:
+        peers = await wait_for_peers([keys[coin] for coin in rest], lambda: read_peer_prices(rest))
+        if peers is None:
+            # the peer gave up, so this would be a second call for the batch; it must fit the budget too
+            if not upstream_budget_available():
+                raise HTTPException(503, "Upstream call budget exhausted, retry shortly")
+            peers = await fetch_prices_upstream(rest)
+        entries.update(peers)
+    return entries
+
+async def flush_price_batch(batch):
+    global PENDING_PRICE_BATCH
+    await asyncio.sleep(COALESCE_WINDOW_MS / 1000)
+    if PENDING_PRICE_BATCH is batch:
+        PENDING_PRICE_BATCH = None
     
+    COALESCE_STATS["requests_served"] += batch["requests"]
+    COALESCE_STATS["last_batch_requests"] = batch["requests"]
+    COALESCE_STATS["last_batch_ids"] = len(batch["ids"])
     try:
-        l0_key = f"l0_prices_{coins}"
-        if l0_key in L0_CACHE:
-            result = L0_CACHE[l0_key]
-            result["_cache"] = "L0_HIT"
-            result["_run_id"] = run_id
-            result["attestation"] = generate_attestation(run_id, inputs, result, TOOL_VERSION)
-            log_event("CACHE_HIT", run_id, {"layer": "L0", "coins": coins})
-            return result
-        
-        l1_key = f"l1_prices_{coins}"
-        cached = l1_get(l1_key)
-        if cached and not cached.get("_stale"):
-            L0_CACHE[l0_key] = cached
-            cached["_cache"] = "L1_HIT"
-            cached["_run_id"] = run_id
-            cached["attestation"] = generate_attestation(run_id, inputs, cached, TOOL_VERSION)
-            log_event("CACHE_HIT", run_id, {"layer": "L1", "coins": coins})
-            return cached
-        
-        if not check_circuit("coingecko"):
-            if cached and cached.get("_stale"):
-                cached["_cache"] = "STALE_DEGRADED"
-                cached["_circuit_open"] = True
-                cached["_run_id"] = run_id
-                cached["attestation"] = generate_attestation(run_id, inputs, cached, TOOL_VERSION)
-                log_event("CIRCUIT_DEGRADED", run_id, {"coins": coins})
-                return cached
-            raise HTTPException(503, "Service temporarily unavailable (circuit open)")
-        
-        ids = coins.replace(" ", "").lower()
-        r = requests.get(
-            f"https://api.coingecko.com/api/v3/simple/price?ids={ids}&vs_currencies=usd&include_24hr_change=true",
-            timeout=5
-        )
-        r.raise_for_status()
-        
-        data = r.json()
-        result = {
-            "timestamp": datetime.utcnow().isoformat(),
-            "prices": data,
+        entries = await fetch_prices_shared(batch["ids"])
+        record_success("coingecko")
+        batch["future"].set_result(entries)
+    except Exception as e:
+        if isinstance(e, httpx.HTTPError):
+            record_failure("coingecko")
+        batch["future"].set_exception(e)
+    finally:
+        for coin in batch["ids"]:
+            if PRICE_INFLIGHT.get(coin) is batch:
+                del PRICE_INFLIGHT[coin]
+    log_event("UPSTREAM_BATCH", None, {"service": "coingecko", "ids": len(batch["ids"]), "coalesced_requests": batch["requests"]})
+
+async def coalesced_fetch(ids):
+    """Single-flight per coin plus micro-batching: concurrent misses share one simple/price call."""
+    global PENDING_PRICE_BATCH
+    batches = []
+    for coin in ids:
+        batch = PRICE_INFLIGHT.get(coin)
+        if batch is None:
+            if PENDING_PRICE_BATCH is None or len(PENDING_PRICE_BATCH["ids"]) >= COALESCE_MAX_IDS:
+                PENDING_PRICE_BATCH = {"ids": [], "requests": 0, "future": asyncio.get_running_loop().create_future()}
+                PENDING_PRICE_BATCH["future"].add_done_callback(lambda f: f.cancelled() or f.exception())
+                spawn(flush_price_batch(PENDING_PRICE_BATCH))
+            batch = PENDING_PRICE_BATCH
+            batch["ids"].append(coin)
+            PRICE_INFLIGHT[coin] = batch
+        if batch not in batches:
+            batches.append(batch)
+            batch["requests"] += 1
+    
+    entries = {}
+    for batch in batches:
+        entries.update(await asyncio.shield(batch["future"]))
+    return {coin: entries[coin] for coin in ids}
+
+PREFETCH_INTERVAL = float(os.getenv("PREFETCH_INTERVAL", 10))
+PREFETCH_LEAD_S = int(os.getenv("PREFETCH_LEAD_S", 30))
+PREFETCH_TOP_N = int(os.getenv("PREFETCH_TOP_N", 50))
+
+REFRESHING = set()
+
+async def revalidate(keys, refresh):
+    try:
+        await refresh()
+    except Exception as e:
+        log_event("REVALIDATE_ERROR", None, {"keys": [k[:80] for k in keys], "error": str(e)})
+    finally:
+        REFRESHING.difference_update(keys)
+
+def schedule_revalidate(background_tasks, keys, refresh):
+    """Queue one background refresh for stale keys that are not already being refreshed."""
+    keys = [k for k in keys if k not in REFRESHING]
+    if keys:
+        REFRESHING.update(keys)
+        background_tasks.add_task(revalidate, keys, lambda: refresh(keys))
+    return keys
+
+async def prefetch_hot_prices():
+    """Refresh the most requested coins shortly before their L1 entry expires."""
+    now = int(time.time())
+    due = []
+    for l0_key, _ in L0_ACCESS_COUNTS.most_common(PREFETCH_TOP_N):
+        if not l0_key.startswith("l0_price_") or l0_key in REFRESHING:
+            continue
+        coin = l0_key[len("l0_price_"):]
+        entry = L0_CACHE.get(l0_key) or await l1_get(f"l1_price_{coin}")
+        if entry is None or entry["fetched_at"] + PRICE_TTL - PREFETCH_LEAD_S <= now:
+            due.append(coin)
+    
+    # halve counts each pass so hotness follows recent traffic
+    for l0_key in list(L0_ACCESS_COUNTS):
+        L0_ACCESS_COUNTS[l0_key] //= 2
+        if not L0_ACCESS_COUNTS[l0_key]:
+            del L0_ACCESS_COUNTS[l0_key]
+    
+    if due and check_circuit("coingecko") and upstream_budget_available():
+        keys = [f"l0_price_{coin}" for coin in due]
+        REFRESHING.update(keys)
+        await revalidate(keys, lambda: coalesced_fetch(due))
+        log_event("PREFETCH", None, {"coins": due})
+
+async def prefetch_loop():
+    while True:
+        await asyncio.sleep(PREFETCH_INTERVAL)
+        try:
+            await prefetch_hot_prices()
+        except Exception as e:
+            logger.warning(f"Prefetch pass failed: {e}")
+
+def etag_matches(request, etag):
+    """Weak If-None-Match comparison, so polling clients can be answered with a bodyless 304."""
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    tags = [tag.strip().removeprefix("W/") for tag in header.split(",")]
+    return "*" in tags or etag.removeprefix("W/") in tags
+
+PRICE_BODIES = LRUCache(maxsize=1000)
+
+def price_entry(ids, entries):
+    """Encoded body for a coin set, rebuilt only when one of its per-coin entries changes."""
+    coins = ",".join(ids)
+    stamp = tuple(entries[coin]["fetched_at"] for coin in ids)
+    entry = PRICE_BODIES.get(coins)
+    if entry is None or entry["stamp"] != stamp:
+        payload = {
+            "prices": {coin: entries[coin]["data"] for coin in ids if entries[coin]["data"] is not None},
             "source": "CoinGecko",
-            "_cache": "LIVE",
-            "_run_id": run_id,
-            "next_actions": generate_next_actions("prices", coin=coins.split(",")[0]),
-            "attestation": generate_attestation(run_id, inputs, data, TOOL_VERSION),
-            "trust_signals": {
-                "data_freshness_seconds": 0,
-                "circuit_state": "CLOSED",
-                "cache_layers": ["L0", "L1"]
-            }
+            "next_actions": generate_next_actions("prices", coin=ids[0])
         }
+        entry = encode_entry(payload, {"coins": coins, "endpoint": "prices"})
+        entry["stamp"] = stamp
+        entry["etag"] = f'W/"{entry["hash"][:32]}"'
+        PRICE_BODIES[coins] = entry
+    return entry
+
+def price_fields(run_id, entry, cache_status, circuit_state="CLOSED"):
+    return {
+        "timestamp": datetime.utcnow().isoformat(),
+        "_cache": cache_status,
+        "_run_id": run_id,
+        "attestation": attestation_from_hashes(run_id, entry["inputs_hash"], entry["hash"], TOOL_VERSION),
+        "trust_signals": {
+            "data_freshness_seconds": max(0, int(time.time()) - min(entry["stamp"])),
+            "circuit_state": circuit_state,
+            "cache_layers": ["L0", "L1"]
+        }
+    }
+
+async def prices_call(coins, background_tasks, run_id):
+    """Resolve a /prices call to (encoded entry, per-request fields, etag); shared by /prices and /batch."""
+    ids = parse_coins(coins)
+    if not ids:
+        raise HTTPException(400, "No coin IDs given")
+    coins = ",".join(ids)
+    
+    try:
+        entries, layers, stale, missing = {}, set(), {}, []
+        for coin in ids:
+            entry, layer = await get_cached_coin(coin)
+            if layer in ("L0", "L1"):
+                entries[coin] = entry
+                layers.add(layer)
+            else:
+                if entry:
+                    stale[coin] = entry
+                missing.append(coin)
         
-        L0_CACHE[l0_key] = result
-        l1_set(l1_key, result, ttl=300)
-        
-        CIRCUIT_STATE["coingecko"]["failures"] = 0
-        log_event("TOOL_CALLED", run_id, {"endpoint": "prices", "coins": coins, "source": "live"})
+        circuit_state = "CLOSED"
+        if not missing:
+            layer = "L1" if "L1" in layers else "L0"
+            cache_status = f"{layer}_HIT"
+            log_event("CACHE_HIT", run_id, {"layer": layer, "coins": coins})
+        else:
+            circuit_ok = check_circuit("coingecko")
+            if not circuit_ok or not upstream_budget_available():
+                if len(stale) != len(missing):
+                    if not circuit_ok:
+                        raise HTTPException(503, "Service temporarily unavailable (circuit open)")
+                    raise HTTPException(503, "Upstream call budget exhausted, retry shortly")
+                entries.update(stale)
+                cache_status, circuit_state = "STALE_DEGRADED", "CLOSED" if circuit_ok else "OPEN"
+                log_event("CIRCUIT_DEGRADED", run_id, {"coins": coins, "budget_exhausted": circuit_ok})
+            elif len(stale) == len(missing):
+                # stale-while-revalidate: answer now, refresh off the request path
+                entries.update(stale)
+                schedule_revalidate(background_tasks, [f"l0_price_{coin}" for coin in missing],
+                                    lambda keys: coalesced_fetch([k[len("l0_price_"):] for k in keys]))
+                cache_status = "STALE_REVALIDATING"
+                log_event("CACHE_HIT", run_id, {"layer": "STALE", "coins": coins})
+            else:
+                entries.update(await coalesced_fetch(missing))
+                cache_status = "LIVE"
+                log_event("TOOL_CALLED", run_id, {"endpoint": "prices", "coins": coins, "fetched": missing, "source": "live"})
         
-        return result
+        entry = price_entry(ids, entries)
+        fields = price_fields(run_id, entry, cache_status, circuit_state=circuit_state)
+        if cache_status == "STALE_DEGRADED":
+            fields["_circuit_open"] = circuit_state == "OPEN"
+        return entry, fields, entry["etag"]
         
-    except requests.RequestException as e:
-        record_failure("coingecko")
+    except HTTPException:
+        raise
+    except httpx.HTTPError as e:
+        # the coalescer records one circuit failure per upstream call, not per waiter
         log_event("DOWNSTREAM_ERROR", run_id, {"error": str(e), "circuit_failures": CIRCUIT_STATE["coingecko"]["failures"]})
         raise HTTPException(502, f"Price source unavailable: {str(e)}")
     except Exception as e:
         log_event("ERROR", run_id, {"error": str(e)})
         raise HTTPException(500, str(e))
 
-@app.get("/fetch")
-@limiter.limit("30/minute")
-async def web_fetch(request: Request, url: str):
-    run_id = f"fetch_{int(time.time()*1000)}"
-    inputs = {"url": url, "endpoint": "fetch"}
+def tool_response(request, entry, fields, etag=None):
+    request.state.cache_outcome = fields.get("_cache", "none")
+    if etag and etag_matches(request, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    return render_response(request, entry, fields, {"ETag": etag} if etag else None)
+
+@app.get("/prices")
+@limiter.shared_limit(RATE_LIMITS["prices"], scope="prices")
+async def get_prices(request: Request, background_tasks: BackgroundTasks, coins: str = DEFAULT_COINS):
+    run_id = f"price_{int(time.time()*1000)}"
+    return tool_response(request, *await prices_call(coins, background_tasks, run_id))
+
+FETCH_TTL = int(os.getenv("FETCH_TTL", 3600))
+
+FETCH_MAX_BYTES = int(os.getenv("FETCH_MAX_BYTES", 2 * 1024 * 1024))
+FETCH_MAX_TEXT = 8000
+FETCH_MAX_TABLES = 5
+FETCH_MAX_LINKS = 20
+EXTRACT_WORKERS = int(os.getenv("EXTRACT_WORKERS", min(4, os.cpu_count() or 1)))
+EXTRACT_CHUNK = 65536
+
+EXTRACT_POOL = None
+
+def new_extract_pool():
+    # forkserver: forking this process would copy the L1/shared executor threads' locks into the children
+    return ProcessPoolExecutor(max_workers=EXTRACT_WORKERS, mp_context=multiprocessing.get_context("forkserver"))
+
+async def run_extract(fn, *args):
+    """Run in the extraction pool. A pool broken by a dead child (e.g. OOM-killed) is replaced and the call retried once."""
+    global EXTRACT_POOL
+    loop = asyncio.get_running_loop()
+    pool = EXTRACT_POOL
+    try:
+        return await loop.run_in_executor(pool, fn, *args)
+    except BrokenProcessPool:
+        if EXTRACT_POOL is pool:
+            logger.warning("Extraction pool broken, recreating it")
+            pool.shutdown(wait=False, cancel_futures=True)
+            EXTRACT_POOL = new_extract_pool()
+        return await loop.run_in_executor(EXTRACT_POOL, fn, *args)
+
+class PageExtractor:
+    """lxml parser target collecting title, text, tables and links in one pass over the document."""
+    SKIP_TAGS = {"script", "style", "template"}
+    
+    def __init__(self, max_text, max_tables, max_links):
+        self.max_text, self.max_tables, self.max_links = max_text, max_tables, max_links
+        self.title, self.in_title, self.past_head = None, False, False
+        self.text, self.text_len = [], 0
+        self.tables, self.open_tables = [], []
+        self.links = []
+        self.skip_depth = 0
     
-    if not url.startswith("http"):
-        url = "https://" + url
+    @property
+    def done(self):
+        return (self.past_head and self.text_len >= self.max_text
+                and len(self.tables) >= self.max_tables and not self.open_tables
+                and len(self.links) >= self.max_links)
     
+    def start(self, tag, attrib):
+        if tag in self.SKIP_TAGS:
+            self.skip_depth += 1
+        elif tag == "title" and self.title is None:
+            self.in_title, self.title = True, ""
+        elif tag == "body":
+            self.past_head = True
+        elif tag == "table":
+            if len(self.tables) < self.max_tables:
+                parts = []
+                self.tables.append(parts)
+                self.open_tables.append(parts)
+            else:
+                self.open_tables.append(None)
+        elif tag == "a" and "href" in attrib and len(self.links) < self.max_links:
+            self.links.append(attrib["href"])
+    
+    def end(self, tag):
+        if tag in self.SKIP_TAGS:
+            self.skip_depth = max(0, self.skip_depth - 1)
+        elif tag == "title":
+            self.in_title, self.past_head = False, True
+        elif tag == "table" and self.open_tables:
+            self.open_tables.pop()
+    
+    def data(self, data):
+        if self.skip_depth:
+            return
+        if self.in_title:
+            self.title += data
+        stripped = data.strip()
+        if not stripped:
+            return
+        if self.text_len < self.max_text:
+            self.text.append(stripped)
+            self.text_len += len(stripped) + 1
+        for parts in self.open_tables:
+            if parts is not None:
+                parts.append(stripped)
+    
+    def close(self):
+        return {
+            "title": self.title.strip() if self.title is not None else None,
+            "clean_content": " ".join(self.text)[:self.max_text],
+            "tables": [" | ".join(parts) for parts in self.tables],
+            "links": self.links
+        }
+
+def extract_html(body, encoding, max_text=FETCH_MAX_TEXT, max_tables=FETCH_MAX_TABLES, max_links=FETCH_MAX_LINKS):
+    """Runs in the extraction pool: feeds the page in chunks and stops once every output limit is met."""
     try:
-        l0_key = f"l0_fetch_{url}"
-        if l0_key in L0_CACHE:
-            result = L0_CACHE[l0_key]
-            result["_cache"] = "L0_HIT"
-            result["_run_id"] = run_id
-            return result
-        
-        l1_key = f"l1_fetch_{url}"
-        cached = l1_get(l1_key)
-        if cached and not cached.get("_stale"):
-            L0_CACHE[l0_key] = cached
-            cached["_cache"] = "L1_HIT"
-            cached["_run_id"] = run_id
-            return cached
-        
-        if not check_circuit("fetch"):
-            if cached and cached.get("_stale"):
-                cached["_cache"] = "STALE_DEGRADED"
-                cached["_circuit_open"] = True
-                return cached
-            raise HTTPException(503, "Fetch service temporarily unavailable")
-        
-        r = requests.get(url, headers={"User-Agent": "SparkyBot/2.0-Legion"}, timeout=10)
-        r.raise_for_status()
-        
-        html = r.text
-        soup = BeautifulSoup(html, "lxml")
+        html = body.decode(encoding or "utf-8", errors="replace")
+    except LookupError:
+        # unknown charset label in Content-Type; a bad header is not an upstream failure
+        html = body.decode("utf-8", errors="replace")
+    target = PageExtractor(max_text, max_tables, max_links)
+    parser = lazy_import("lxml.etree").HTMLParser(target=target)
+    for i in range(0, len(html), EXTRACT_CHUNK):
+        parser.feed(html[i:i + EXTRACT_CHUNK])
+        if target.done:
+            break
+    return parser.close() if html else target.close()
+
+def store_page(url, payload):
+    entry = encode_entry(payload, {"url": url, "endpoint": "fetch"})
+    L0_CACHE[f"l0_fetch_{url}"] = entry
+    l1_set(f"l1_fetch_{url}", payload, ttl=FETCH_TTL, etag=payload["trust_signals"].get("upstream_etag"))
+    return entry
+
+async def fetch_page(url, cached=None):
+    """Download and extract a page, storing it in L0/L1 and returning the encoded entry.
+
+    With a previous payload, the request is conditional on its ETag/Last-Modified: a 304 only
+    renews the TTL, and an unchanged body (same content_hash) skips re-extraction.
+    """
+    headers = {"User-Agent": "SparkyBot/2.0-Legion"}
+    previous = cached["trust_signals"] if cached else {}
+    if previous.get("upstream_etag"):
+        headers["If-None-Match"] = previous["upstream_etag"]
+    if previous.get("last_modified"):
+        headers["If-Modified-Since"] = previous["last_modified"]
+    
+    try:
+        r, body, truncated = await upstream_stream(url, FETCH_MAX_BYTES, headers=headers, timeout=10)
+        content_hash = hashlib.sha256(body).hexdigest()[:16]
+        if cached and (r.status_code == 304 or content_hash == previous.get("content_hash")):
+            payload = cached_payload(cached)
+            payload["timestamp"] = datetime.utcnow().isoformat()
+            trust = {**previous, "revalidated_by": "304" if r.status_code == 304 else "content_hash"}
+            # keep the validators current: a 200 replaces them, a 304 may refresh them
+            if r.status_code != 304 or r.headers.get("etag"):
+                trust["upstream_etag"] = r.headers.get("etag")
+            if r.status_code != 304 or r.headers.get("last-modified"):
+                trust["last_modified"] = r.headers.get("last-modified")
+            payload["trust_signals"] = trust
+            record_success("fetch")
+            return store_page(url, payload)
+        extracted = await run_extract(extract_html, body, r.charset_encoding)
         
-        result = {
+        payload = {
             "timestamp": datetime.utcnow().isoformat(),
             "url": url,
-            "title": soup.title.string.strip() if soup.title else None,
-            "clean_content": soup.get_text(separator=" ", strip=True)[:8000],
-            "tables": [t.get_text(strip=True, separator=" | ") for t in soup.find_all("table")][:5],
-            "links": [a["href"] for a in soup.find_all("a", href=True)][:20],
+            "title": extracted["title"],
+            "clean_content": extracted["clean_content"],
+            "tables": extracted["tables"],
+            "links": extracted["links"],
             "source": "Sparky Fetch v2",
-            "_cache": "LIVE",
-            "_run_id": run_id,
             "next_actions": generate_next_actions("fetch", url=url),
-            "attestation": generate_attestation(run_id, inputs, {"url": url, "title": soup.title.string if soup.title else None}, TOOL_VERSION),
             "trust_signals": {
-                "content_hash": sha256_hash(html)[:16],
-                "circuit_state": "CLOSED"
+                "content_hash": content_hash,
+                "circuit_state": "CLOSED",
+                "bytes_read": len(body),
+                "truncated": truncated,
+                "upstream_etag": r.headers.get("etag"),
+                "last_modified": r.headers.get("last-modified")
             }
         }
+    except Exception:
+        record_failure("fetch")
+        raise
+    
+    record_success("fetch")
+    return store_page(url, payload)
+
+async def read_peer_entry(l1_key, l0_key, inputs):
+    """A fresh L1 payload written by another worker, encoded into this worker's L0."""
+    cached = await l1_get(l1_key)
+    if cached and not cached.get("_stale"):
+        entry = L0_CACHE[l0_key] = encode_entry(cached_payload(cached), inputs)
+        return entry
+    return None
+
+def fetch_flight(url, previous=None):
+    return shared_flight(f"fetch:{url}", lambda: fetch_page(url, cached=previous),
+                         lambda: read_peer_entry(f"l1_fetch_{url}", f"l0_fetch_{url}", {"url": url, "endpoint": "fetch"}))
+
+def normalize_url(url):
+    return url if url.startswith("http") else "https://" + url
+
+def page_fields(run_id, entry, cache_status, **extra):
+    return {
+        "_cache": cache_status,
+        "_run_id": run_id,
+        "attestation": attestation_from_hashes(run_id, entry["inputs_hash"], entry["hash"], TOOL_VERSION),
+        **extra
+    }
+
+async def fetch_call(url, background_tasks, run_id):
+    """Resolve a /fetch call to (encoded entry, per-request fields, etag); shared by /fetch and /batch."""
+    url = normalize_url(url)
+    
+    try:
+        l0_key = f"l0_fetch_{url}"
+        L0_ACCESS_COUNTS[l0_key] += 1
+        if l0_key in L0_CACHE:
+            entry, fields = L0_CACHE[l0_key], {"cache_status": "L0_HIT"}
+        else:
+            cached = await l1_get(f"l1_fetch_{url}")
+            if cached and not cached.get("_stale"):
+                entry = L0_CACHE[l0_key] = encode_entry(cached_payload(cached), {"url": url, "endpoint": "fetch"})
+                fields = {"cache_status": "L1_HIT"}
+            elif not check_circuit("fetch"):
+                if not (cached and cached.get("_stale")):
+                    raise HTTPException(503, "Fetch service temporarily unavailable")
+                entry = encode_entry(cached_payload(cached), {"url": url, "endpoint": "fetch"})
+                fields = {"cache_status": "STALE_DEGRADED", "_stale": True, "_circuit_open": True}
+            elif cached and cached.get("_stale"):
+                previous = cached_payload(cached)
+                schedule_revalidate(background_tasks, [l0_key], lambda keys: fetch_flight(url, previous))
+                entry = encode_entry(previous, {"url": url, "endpoint": "fetch"})
+                fields = {"cache_status": "STALE_REVALIDATING", "_stale": True}
+            else:
+                entry, fields = await fetch_flight(url), {"cache_status": "LIVE"}
+                log_event("TOOL_CALLED", run_id, {"endpoint": "fetch", "url": url[:50]})
         
-        L0_CACHE[l0_key] = result
-        l1_set(l1_key, result, ttl=3600)
-        
-        CIRCUIT_STATE["fetch"]["failures"] = 0
-        log_event("TOOL_CALLED", run_id, {"endpoint": "fetch", "url": url[:50]})
-        
-        return result
+        etag = f'W/"{entry["payload"]["trust_signals"]["content_hash"]}"'
+        return entry, page_fields(run_id, entry, **fields), etag
         
+    except HTTPException:
+        raise
     except Exception as e:
-        record_failure("fetch")
         log_event("DOWNSTREAM_ERROR", run_id, {"error": str(e)})
         raise HTTPException(500, str(e))
 
-@app.get("/search")
-@limiter.limit("20/minute")
-async def web_search(request: Request, q: str):
-    """Web search via Bing API (fallback if no key)"""
-    run_id = f"search_{int(time.time()*1000)}"
+@app.get("/fetch")
+@limiter.shared_limit(RATE_LIMITS["fetch"], scope="fetch")
+async def web_fetch(request: Request, url: str, background_tasks: BackgroundTasks):
+    run_id = f"fetch_{int(time.time()*1000)}"
+    return tool_response(request, *await fetch_call(url, background_tasks, run_id))
+
+SEARCH_TTL = int(os.getenv("SEARCH_TTL", 7200))
+
+def normalize_query(q):
+    """Case-, whitespace- and Unicode-form-insensitive cache key for a search query."""
+    return " ".join(unicodedata.normalize("NFKC", q).casefold().split())
+
+def parse_bing_results(html, limit=5):
+    """Runs in the extraction pool alongside page extraction."""
+    soup = lazy_import("bs4").BeautifulSoup(html, "lxml")
+    results = []
+    for item in soup.select('.b_algo')[:limit]:
+        title = item.select_one('h2')
+        link = item.select_one('a')
+        snippet = item.select_one('.b_caption p')
+        
+        if title and link:
+            results.append({
+                "title": title.get_text(strip=True),
+                "href": link.get('href', ''),
+                "body": snippet.get_text(strip=True) if snippet else ""
+            })
+    return results
+
+async def search_bing(query):
+    """Scrape Bing for a normalized query, storing it in L0/L1 and returning the encoded entry."""
+    try:
+        headers = {"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36"}
+        r = await upstream_get(BING_URL, params={"q": query}, headers=headers, timeout=10)
+        r.raise_for_status()
+        results = await run_extract(parse_bing_results, r.text)
+    except Exception:
+        record_failure("search")
+        raise
+    
+    payload = {
+        "timestamp": datetime.utcnow().isoformat(),
+        "query": query,
+        "results": results,
+        "source": "Bing (scraped)"
+    }
+    entry = L0_CACHE[f"l0_search_{query}"] = encode_entry(payload, {"q": query, "endpoint": "search"})
+    l1_set(f"l1_search_{query}", payload, ttl=SEARCH_TTL)
+    record_success("search")
+    return entry
+
+def search_flight(query):
+    return shared_flight(f"search:{query}", lambda: search_bing(query),
+                         lambda: read_peer_entry(f"l1_search_{query}", f"l0_search_{query}", {"q": query, "endpoint": "search"}))
+
+async def search_call(q, background_tasks, run_id):
+    """Resolve a /search call to (encoded entry, per-request fields, etag); shared by /search and /batch."""
+    query = normalize_query(q)
+    if not query:
+        raise HTTPException(400, "Empty search query")
     
     # Fallback: use web scrape of Bing search results
     try:
-        search_url = f"https://www.bing.com/search?q={q.replace(' ', '+')}"
-        headers = {"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36"}
-        r = requests.get(search_url, headers=headers, timeout=10)
+        l0_key = f"l0_search_{query}"
+        L0_ACCESS_COUNTS[l0_key] += 1
+        if l0_key in L0_CACHE:
+            return L0_CACHE[l0_key], {"_cache": "L0_HIT", "_run_id": run_id}, None
         
-        from bs4 import BeautifulSoup
-        soup = BeautifulSoup(r.text, 'html.parser')
+        cached = await l1_get(f"l1_search_{query}")
+        if cached and not cached.get("_stale"):
+            entry = L0_CACHE[l0_key] = encode_entry(cached_payload(cached), {"q": query, "endpoint": "search"})
+            return entry, {"_cache": "L1_HIT", "_run_id": run_id}, None
         
-        results = []
-        for item in soup.select('.b_algo')[:5]:
-            title = item.select_one('h2')
-            link = item.select_one('a')
-            snippet = item.select_one('.b_caption p')
-            
-            if title and link:
-                results.append({
-                    "title": title.get_text(strip=True),
-                    "href": link.get('href', ''),
-                    "body": snippet.get_text(strip=True) if snippet else ""
-                })
+        if not check_circuit("search"):
+            if cached and cached.get("_stale"):
+                entry = encode_entry(cached_payload(cached), {"q": query, "endpoint": "search"})
+                return entry, {"_cache": "STALE_DEGRADED", "_run_id": run_id, "_stale": True, "_circuit_open": True}, None
+            raise HTTPException(503, "Search service temporarily unavailable (circuit open)")
         
-        return {
-            "timestamp": datetime.utcnow().isoformat(),
-            "query": q,
-            "results": results,
-            "source": "Bing (scraped)",
-            "_cache": "LIVE",
-            "_run_id": run_id
-        }
+        if cached and cached.get("_stale"):
+            schedule_revalidate(background_tasks, [l0_key], lambda keys: search_flight(query))
+            entry = encode_entry(cached_payload(cached), {"q": query, "endpoint": "search"})
+            return entry, {"_cache": "STALE_REVALIDATING", "_run_id": run_id, "_stale": True}, None
+        
+        entry = await search_flight(query)
+        log_event("TOOL_CALLED", run_id, {"endpoint": "search", "q": query[:50]})
+        return entry, {"_cache": "LIVE", "_run_id": run_id}, None
+    except HTTPException:
+        raise
     except Exception as e:
+        log_event("DOWNSTREAM_ERROR", run_id, {"error": str(e), "circuit_failures": CIRCUIT_STATE["search"]["failures"]})
         raise HTTPException(503, f"Search temporarily limited: {str(e)}")
 
+@app.get("/search")
+@limiter.shared_limit(RATE_LIMITS["search"], scope="search")
+async def web_search(request: Request, q: str, background_tasks: BackgroundTasks):
+    """Web search via Bing API (fallback if no key)"""
+    run_id = f"search_{int(time.time()*1000)}"
+    return tool_response(request, *await search_call(q, background_tasks, run_id))
+
+BATCH_MAX_CALLS = int(os.getenv("BATCH_MAX_CALLS", 25))
+BATCH_CONCURRENCY = {
+    "prices": int(os.getenv("BATCH_PRICES_CONCURRENCY", 8)),
+    "fetch": int(os.getenv("BATCH_FETCH_CONCURRENCY", 4)),
+    "search": int(os.getenv("BATCH_SEARCH_CONCURRENCY", 2))
+}
+BATCH_SEMAPHORES = {tool: asyncio.Semaphore(n) for tool, n in BATCH_CONCURRENCY.items()}
+
+# tool names as used in next_actions and the agent card map onto the endpoints
+BATCH_TOOLS = {
+    "prices": ("prices", prices_call, "coins"), "get_prices": ("prices", prices_call, "coins"),
+    "fetch": ("fetch", fetch_call, "url"), "web_fetch": ("fetch", fetch_call, "url"),
+    "search": ("search", search_call, "q"), "web_search": ("search", search_call, "q")
+}
+BATCH_NORMALIZERS = {
+    "prices": lambda v: ",".join(parse_coins(v)),
+    "fetch": normalize_url,
+    "search": normalize_query
+}
+
+class BatchCall(BaseModel):
+    tool: str
+    params: dict = {}
+
+class BatchRequest(BaseModel):
+    calls: List[BatchCall]
+    stream: bool = False
+
+def charge_rate_limit(request, tool):
+    """Count one sub-call against the same slowapi bucket the tool's own endpoint uses."""
+    return limiter.limiter.hit(parse_limit(RATE_LIMITS[tool]), get_remote_address(request), tool)
+
+async def run_batch_call(key, call, value, background_tasks, run_id):
+    try:
+        async with BATCH_SEMAPHORES[key[0]]:
+            entry, fields, _ = await call(value, background_tasks, run_id)
+        return key, 200, render_body(entry, fields)
+    except HTTPException as e:
+        return key, e.status_code, orjson.dumps({"detail": e.detail})
+
+def batch_item(index, tool, status, body):
+    key = b'"result":' if status == 200 else b'"error":'
+    return orjson.dumps({"index": index, "tool": tool, "status": status})[:-1] + b"," + key + body + b"}"
+
+@app.post("/batch")
+async def batch(request: Request, body: BatchRequest, background_tasks: BackgroundTasks):
+    """Run several prices/fetch/search calls concurrently in one round trip."""
+    batch_id = f"batch_{int(time.time()*1000)}"
+    if len(body.calls) > BATCH_MAX_CALLS:
+        raise HTTPException(400, f"At most {BATCH_MAX_CALLS} calls per batch")
+    
+    # identical sub-calls run once and are charged once
+    unique, indexes, errors = {}, {}, {}
+    for i, c in enumerate(body.calls):
+        if c.tool not in BATCH_TOOLS:
+            errors[i] = (c.tool, 400, orjson.dumps({"detail": f"Unknown tool {c.tool}"}))
+            continue
+        tool, call, param = BATCH_TOOLS[c.tool]
+        value = c.params.get(param, DEFAULT_COINS if tool == "prices" else None)
+        if not isinstance(value, str):
+            errors[i] = (c.tool, 400, orjson.dumps({"detail": f"Missing string param '{param}'"}))
+            continue
+        key = (tool, BATCH_NORMALIZERS[tool](value))
+        if key not in unique:
+            unique[key] = (call, value)
+        indexes.setdefault(key, []).append(i)
+    
+    tasks = {}
+    for j, (key, (call, value)) in enumerate(unique.items()):
+        tool = key[0]
+        if not charge_rate_limit(request, tool):
+            for i in indexes[key]:
+                errors[i] = (tool, 429, orjson.dumps({"detail": f"Rate limit exceeded: {RATE_LIMITS[tool]}"}))
+            continue
+        tasks[key] = asyncio.ensure_future(run_batch_call(key, call, value, background_tasks, f"{batch_id}_{j}"))
+    log_event("TOOL_CALLED", batch_id, {"endpoint": "batch", "calls": len(body.calls), "unique": len(unique)})
+    
+    if body.stream:
+        async def stream():
+            for i, (tool, status, detail) in errors.items():
+                yield batch_item(i, tool, status, detail) + b"\n"
+            for done in asyncio.as_completed(tasks.values()):
+                key, status, result = await done
+                for i in indexes[key]:
+                    yield batch_item(i, key[0], status, result) + b"\n"
+        return StreamingResponse(stream(), media_type="application/x-ndjson")
+    
+    items = [None] * len(body.calls)
+    for i, (tool, status, detail) in errors.items():
+        items[i] = batch_item(i, tool, status, detail)
+    for key, status, result in await asyncio.gather(*tasks.values()):
+        for i in indexes[key]:
+            items[i] = batch_item(i, key[0], status, result)
+    content = b'{"results":[' + b",".join(items) + b'],' + orjson.dumps({"count": len(items), "unique_calls": len(unique), "_run_id": batch_id})[1:]
+    return Response(content=content, media_type="application/json")
+
+STREAM_INTERVAL = float(os.getenv("STREAM_INTERVAL", 15))
+STREAM_HEARTBEAT = float(os.getenv("STREAM_HEARTBEAT", 20))
+STREAM_QUEUE_SIZE = int(os.getenv("STREAM_QUEUE_SIZE", 16))
+STREAM_MAX_SUBSCRIBERS = int(os.getenv("STREAM_MAX_SUBSCRIBERS", 5000))
+STREAM_MAX_COINS = int(os.getenv("STREAM_MAX_COINS", 50))
+
+STREAM_SUBSCRIBERS = {}
+STREAM_COINS = Counter()
+STREAM_LAST = {}
+STREAM_WAKE = asyncio.Event()
+STREAM_STATS = {"polls": 0, "messages": 0, "dropped_subscribers": 0}
+
+def sse(event, data):
+    return b"event: " + event.encode() + b"\ndata: " + orjson.dumps(data) + b"\n\n"
+
+def stream_subscribe(ids):
+    sub = {"coins": frozenset(ids), "queue": asyncio.Queue(maxsize=STREAM_QUEUE_SIZE)}
+    STREAM_SUBSCRIBERS[id(sub)] = sub
+    if any(not STREAM_COINS[coin] for coin in ids):
+        STREAM_WAKE.set()
+    STREAM_COINS.update(ids)
+    return sub
+
+def stream_unsubscribe(sub):
+    if STREAM_SUBSCRIBERS.pop(id(sub), None) is None:
+        return
+    STREAM_COINS.subtract(sub["coins"])
+    for coin in sub["coins"]:
+        if STREAM_COINS[coin] <= 0:
+            del STREAM_COINS[coin]
+            STREAM_LAST.pop(coin, None)
+
+def stream_fanout(changed):
+    """Push changed prices to each subscriber; a subscriber whose queue is full is dropped."""
+    encoded = {}
+    for sub in list(STREAM_SUBSCRIBERS.values()):
+        coins = tuple(sorted(sub["coins"].intersection(changed)))
+        if not coins:
+            continue
+        # subscribers to the same coin set share one encoded message
+        if coins not in encoded:
+            encoded[coins] = sse("prices", {"timestamp": datetime.utcnow().isoformat(), "prices": {coin: changed[coin] for coin in coins}})
+        try:
+            sub["queue"].put_nowait(encoded[coins])
+            STREAM_STATS["messages"] += 1
+        except asyncio.QueueFull:
+            stream_unsubscribe(sub)
+            sub["queue"].get_nowait()
+            sub["queue"].put_nowait(None)
+            STREAM_STATS["dropped_subscribers"] += 1
+
+async def stream_poll():
+    coins = list(STREAM_COINS)
+    if not coins or not check_circuit("coingecko") or not upstream_budget_available():
+        return
+    entries = await coalesced_fetch(coins)
+    STREAM_STATS["polls"] += 1
+    changed = {}
+    for coin, entry in entries.items():
+        if entry["data"] is not None and STREAM_LAST.get(coin) != entry["data"] and coin in STREAM_COINS:
+            changed[coin] = STREAM_LAST[coin] = entry["data"]
+    if changed:
+        stream_fanout(changed)
+
+async def stream_poller_loop():
+    """One upstream poll per interval for the union of subscribed coins, regardless of subscriber count."""
+    while True:
+        try:
+            await asyncio.wait_for(STREAM_WAKE.wait(), STREAM_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        STREAM_WAKE.clear()
+        try:
+            await stream_poll()
+        except Exception as e:
+            logger.warning(f"Price stream poll failed: {e}")
+
+async def price_events(ids, snapshot):
+    # subscribing inside the generator ties registration to the finally below
+    sub = stream_subscribe(ids)
+    log_event("STREAM_SUBSCRIBED", None, {"coins": ",".join(ids), "subscribers": len(STREAM_SUBSCRIBERS)})
+    try:
+        yield sse("snapshot", {"timestamp": datetime.utcnow().isoformat(), "prices": snapshot})
+        while True:
+            try:
+                message = await asyncio.wait_for(sub["queue"].get(), STREAM_HEARTBEAT)
+            except asyncio.TimeoutError:
+                yield b": ping\n\n"
+                continue
+            if message is None:
+                yield sse("dropped", {"reason": "slow consumer"})
+                break
+            yield message
+    finally:
+        stream_unsubscribe(sub)
+
+@app.get("/prices/stream")
+@limiter.shared_limit(RATE_LIMITS["prices"], scope="prices")
+async def stream_prices(request: Request, coins: str = DEFAULT_COINS):
+    """Server-sent events: a snapshot, then only the prices that changed on each poll."""
+    ids = parse_coins(coins)
+    if not ids or len(ids) > STREAM_MAX_COINS:
+        raise HTTPException(400, f"Subscribe to between 1 and {STREAM_MAX_COINS} coin IDs")
+    if len(STREAM_SUBSCRIBERS) >= STREAM_MAX_SUBSCRIBERS:
+        raise HTTPException(503, "Too many stream subscribers, retry later")
+    
+    snapshot = {}
+    for coin in ids:
+        entry, _ = await get_cached_coin(coin)
+        if entry and entry["data"] is not None:
+            snapshot[coin] = entry["data"]
+    return StreamingResponse(
+        price_events(ids, snapshot),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+SERIES_POINTS = int(os.getenv("SERIES_POINTS", 8192))
+SERIES_MEMORY_BYTES = int(os.getenv("SERIES_MEMORY_BYTES", 32 * 1024 * 1024))
+SERIES_SNAPSHOT_PATH = os.getenv("SERIES_SNAPSHOT_PATH", "sparky_series.npz")
+SERIES_SNAPSHOT_INTERVAL = float(os.getenv("SERIES_SNAPSHOT_INTERVAL", 300))
+# two float64 columns per point
+SERIES_MAX_COINS = max(1, SERIES_MEMORY_BYTES // (SERIES_POINTS * 16))
+
+# coin -> {"ts", "price" (fixed-size float64 ring columns), "pos" (next slot), "count", "updated"}
+SERIES = {}
+SERIES_RESTORED = False
+SERIES_SYNC = {"last_id": 0}
+
+def new_series():
+    # array('d') rather than numpy, so recording a price never imports numpy on the event loop
+    return {"ts": array("d", bytes(8 * SERIES_POINTS)), "price": array("d", bytes(8 * SERIES_POINTS)),
+            "pos": 0, "count": 0, "updated": 0.0}
+
+def record_price(coin, ts, price):
+    if not price > 0:
+        return
+    series = SERIES.get(coin)
+    if series is None:
+        if len(SERIES) >= SERIES_MAX_COINS:
+            # stay inside the memory budget by dropping the coin that was observed least recently
+            del SERIES[min(SERIES, key=lambda c: SERIES[c]["updated"])]
+        series = SERIES[coin] = new_series()
+    last = (series["pos"] - 1) % SERIES_POINTS
+    if series["count"] and series["ts"][last] >= ts:
+        return
+    series["ts"][series["pos"]] = ts
+    series["price"][series["pos"]] = price
+    series["pos"] = (series["pos"] + 1) % SERIES_POINTS
+    series["count"] = min(series["count"] + 1, SERIES_POINTS)
+    series["updated"] = time.time()
+
+def series_arrays(coin):
+    """Chronological copies of a coin's timestamps and prices."""
+    np = lazy_import("numpy")
+    series = SERIES.get(coin)
+    if series is None:
+        return np.empty(0), np.empty(0)
+    n, pos = series["count"], series["pos"]
+    order = np.arange(pos - n, pos) % SERIES_POINTS
+    return np.frombuffer(series["ts"])[order], np.frombuffer(series["price"])[order]
+
+def save_series_snapshot():
+    if not SERIES:
+        return
+    arrays = {}
+    for coin in list(SERIES):
+        ts, price = series_arrays(coin)
+        arrays[f"{coin}__ts"], arrays[f"{coin}__price"] = ts, price
+    tmp = f"{SERIES_SNAPSHOT_PATH}.{os.getpid()}.tmp.npz"
+    lazy_import("numpy").savez(tmp, **arrays)
+    os.replace(tmp, SERIES_SNAPSHOT_PATH)
+
+def read_series_snapshot():
+    with lazy_import("numpy").load(SERIES_SNAPSHOT_PATH) as snapshot:
+        return {name[:-len("__ts")]: (snapshot[name], snapshot[f"{name[:-len('__ts')]}__price"])
+                for name in snapshot.files if name.endswith("__ts")}
+
+def restore_series(snapshot):
+    """Merge snapshot history under any points recorded since startup."""
+    np = lazy_import("numpy")
+    for coin, (ts, price) in snapshot.items():
+        if coin in SERIES:
+            live_ts, live_price = series_arrays(coin)
+            older = ts < live_ts[0] if len(live_ts) else slice(None)
+            ts, price = np.concatenate((ts[older], live_ts)), np.concatenate((price[older], live_price))
+        elif len(SERIES) >= SERIES_MAX_COINS:
+            continue
+        ts, price = ts[-SERIES_POINTS:], price[-SERIES_POINTS:]
+        series = SERIES[coin] = new_series()
+        n = len(ts)
+        np.frombuffer(series["ts"])[:n], np.frombuffer(series["price"])[:n] = ts, price
+        series["pos"], series["count"] = n % SERIES_POINTS, n
+        series["updated"] = float(ts[-1]) if n else 0.0
+
+async def load_series_snapshot():
+    """Runs in the background after startup, so a large snapshot never delays the first request."""
+    global SERIES_RESTORED
+    start = time.perf_counter()
+    try:
+        # checked first so a fresh install never imports numpy just to find there is nothing to load
+        if os.path.exists(SERIES_SNAPSHOT_PATH):
+            restore_series(await asyncio.to_thread(read_series_snapshot))
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logger.warning(f"Could not load price series snapshot: {e}")
+    SERIES_RESTORED = True
+    startup_phase("series_snapshot", start)
+
+async def snapshot_series(final=False):
+    """Only the worker holding the snapshot lease writes it; the others skip this interval. The final
+    save at shutdown ignores the lease, which may still linger for a process that is already gone;
+    per-process temp files and os.replace keep concurrent writes whole."""
+    if final:
+        return await asyncio.to_thread(save_series_snapshot)
+    if not await acquire_leases(["series_snapshot"]):
+        return
+    try:
+        await asyncio.to_thread(save_series_snapshot)
+    finally:
+        await release_leases(["series_snapshot"], linger=SERIES_SNAPSHOT_INTERVAL / 2)
+
+async def series_snapshot_loop():
+    await load_series_snapshot()
+    while True:
+        await asyncio.sleep(SERIES_SNAPSHOT_INTERVAL)
+        try:
+            await snapshot_series()
+        except Exception as e:
+            logger.warning(f"Price series snapshot failed: {e}")
+
+def l1_price_points(after, limit):
+    return L1_CACHE.execute(
+        "SELECT id, coin, ts, price FROM price_points WHERE id > ? ORDER BY id LIMIT ?", (after, limit)
+    ).fetchall()
+
+async def sync_series():
+    """Record prices fetched by other workers, so /metrics/{coin} is the same whichever worker answers."""
+    rows = await run_l1(l1_price_points, SERIES_SYNC["last_id"], 5000)
+    for _, coin, ts, price in rows:
+        record_price(coin, ts, price)
+    if rows:
+        SERIES_SYNC["last_id"] = rows[-1][0]
+
+def parse_threshold(threshold):
+    """Accepts 0.1, 10% or the 10%_swing form used in next_actions."""
+    value = threshold.split("_")[0].strip()
+    if value.endswith("%"):
+        return float(value[:-1]) / 100
+    return float(value)
+
+def compute_metrics(ts, price, rolling, threshold):
+    np = lazy_import("numpy")
+    returns = np.diff(np.log(price))
+    metrics = {
+        "observations": int(len(price)),
+        "first": {"timestamp": float(ts[0]), "usd": float(price[0])},
+        "last": {"timestamp": float(ts[-1]), "usd": float(price[-1])},
+        "change_pct": float((price[-1] / price[0] - 1) * 100),
+        "min": {"timestamp": float(ts[price.argmin()]), "usd": float(price.min())},
+        "max": {"timestamp": float(ts[price.argmax()]), "usd": float(price.max())},
+        "volatility": None,
+        "volatility_annualized": None,
+        "rolling_volatility": None
+    }
+    if len(returns) >= 2:
+        std = float(returns.std(ddof=1))
+        mean_dt = float(np.diff(ts).mean())
+        metrics["volatility"] = std
+        metrics["volatility_annualized"] = std * float(np.sqrt(365 * 86400 / mean_dt)) if mean_dt > 0 else None
+    if len(returns) >= rolling >= 2:
+        # rolling sample std from cumulative sums of r and r^2
+        c1 = np.concatenate(([0.0], np.cumsum(returns)))
+        c2 = np.concatenate(([0.0], np.cumsum(returns * returns)))
+        s1, s2 = c1[rolling:] - c1[:-rolling], c2[rolling:] - c2[:-rolling]
+        rolling_std = np.sqrt(np.maximum(s2 - s1 * s1 / rolling, 0) / (rolling - 1))
+        metrics["rolling_volatility"] = {"window": rolling, "latest": float(rolling_std[-1]), "max": float(rolling_std.max())}
+    
+    drawdown = price / np.maximum.accumulate(price) - 1
+    runup = price / np.minimum.accumulate(price) - 1
+    swing = max(float(-drawdown.min()), float(runup.max()))
+    metrics["swing"] = {
+        "max_drawdown_pct": float(drawdown.min() * 100),
+        "max_runup_pct": float(runup.max() * 100),
+        "threshold_pct": threshold * 100,
+        "triggered": swing >= threshold
+    }
+    return metrics
+
+@app.get("/metrics/{coin}")
+async def coin_metrics(coin: str, days: float = 7, rolling: int = 20, threshold: str = "10%"):
+    """Returns, volatility, range and swing detection from recorded observations; never calls upstream."""
+    coin = coin.strip().lower()
+    # the first call pays the numpy import; keep it off the event loop
+    await asyncio.to_thread(lazy_import, "numpy")
+    try:
+        threshold_value = parse_threshold(threshold)
+    except ValueError:
+        raise HTTPException(400, f"Invalid threshold: {threshold}")
+    if not (math.isfinite(threshold_value) and threshold_value >= 0):
+        raise HTTPException(400, f"Invalid threshold: {threshold}")
+    ts, price = series_arrays(coin)
+    # log returns and drawdowns need positive prices; older snapshots may still hold zeros
+    keep = (ts >= time.time() - days * 86400) & (price > 0)
+    ts, price = ts[keep], price[keep]
+    if len(price) < 2:
+        raise HTTPException(404, f"Not enough observations for {coin} in the last {days} days")
+    return {
+        "timestamp": datetime.utcnow().isoformat(),
+        "coin": coin,
+        "days": days,
+        "metrics": compute_metrics(ts, price, rolling, threshold_value),
+        "source": "Sparky price series (recorded CoinGecko observations)"
+    }
+
 @app.get("/trust")
 async def trust_card():
     return {
@@ -357,6 +2163,7 @@ async def trust_card():
         "capabilities": {
             "l0_cache_ttl_seconds": 60,
             "l1_cache_ttl_seconds": 300,
+            "search_cache_ttl_seconds": SEARCH_TTL,
             "circuit_breaker": True,
             "attestation_signing": True,
             "next_actions": True
@@ -399,30 +2206,71 @@ async def agent_card():
                 "cache_layers": ["L0", "L1"],
                 "attestation": True,
                 "chains_with": ["web_fetch", "source_analyzer", "authority_ranker"]
+            },
+            {
+                "name": "crypto_metrics",
+                "description": "Returns, volatility, min/max and swing detection from recorded price observations (GET /metrics/{coin}). Covers price_alert via threshold.",
+                "parameters": {"type": "object", "properties": {"coin": {"type": "string"}, "days": {"type": "number"}, "threshold": {"type": "string"}}, "required": ["coin"]},
+                "cache_layers": [],
+                "attestation": False,
+                "chains_with": ["get_prices", "price_alert"]
             }
         ]
     }
 
 @app.get("/events")
-async def query_events(limit: int = 100):
-    try:
-        with open('sparky_events.jsonl', 'r') as f:
-            lines = f.readlines()
-            events = [json.loads(line) for line in lines[-limit:]]
-            return {"events": events, "count": len(events)}
-    except FileNotFoundError:
-        return {"events": [], "count": 0}
+async def query_events(limit: int = 100, type: str = None, run_id: str = None):
+    limit = max(1, min(limit, 1000))
+    # events still waiting for the writer are newer than anything on disk
+    pending = [e for e in list(EVENT_QUEUE) if (type is None or e["type"] == type) and (run_id is None or e["run_id"] == run_id)]
+    events = pending[-limit:]
+    if len(events) < limit:
+        events = await asyncio.to_thread(tail_events, limit - len(events), type, run_id) + events
+    return {"events": events, "count": len(events)}
 
 @app.get("/circuits")
 async def circuit_status():
     return {"circuits": CIRCUIT_STATE, "threshold": CIRCUIT_THRESHOLD, "timeout_seconds": CIRCUIT_TIMEOUT}
 
+@app.get("/metrics")
+async def prometheus_metrics():
+    """Prometheus text format. Each worker serves its own registry; shared-state counters are per host."""
+    snapshot = {
+        "sparky_event_queue_depth": ("gauge", "Events waiting for the background log writer", {(): len(EVENT_QUEUE)}),
+        "sparky_events_dropped_total": ("counter", "Events dropped because the queue was full", {(): EVENT_LOG_STATE["dropped"]}),
+        "sparky_l0_entries": ("gauge", "Entries in this worker's L0 cache", {(): len(L0_CACHE)}),
+        "sparky_l1_pending_writes": ("gauge", "L1 writes waiting for the next group commit", {(): len(L1_PENDING)}),
+        "sparky_l1_events_total": ("counter", "L1 lookups, writes, commits and evictions",
+                                   {(("event", k),): v for k, v in L1_STATS.items()}),
+        "sparky_circuit_open": ("gauge", "1 while a circuit breaker is open",
+                                {(("service", k),): int(v["open"]) for k, v in CIRCUIT_STATE.items()}),
+        "sparky_coalesced_requests_total": ("counter", "Price requests served by coalesced upstream batches",
+                                            {(): COALESCE_STATS["requests_served"]}),
+        "sparky_stream_subscribers": ("gauge", "Open /prices/stream connections", {(): len(STREAM_SUBSCRIBERS)}),
+    }
+    return Response(render_metrics(snapshot), media_type="text/plain; version=0.0.4; charset=utf-8")
+
 @app.get("/health")
 async def health():
     return {
         "status": "ok",
         "version": TOOL_VERSION,
-        "cache_stats": {"l0_size": len(L0_CACHE), "l1_connected": L1_CACHE is not None},
+        "cache_stats": {
+            "l0_size": len(L0_CACHE),
+            "l1_connected": L1_CACHE is not None,
+            "l1": {**L1_STATS, "pending_writes": len(L1_PENDING), "max_rows": L1_MAX_ROWS, "max_bytes": L1_MAX_BYTES}
+        },
+        "coalescing": {
+            **COALESCE_STATS,
+            "avg_requests_per_upstream_call": round(COALESCE_STATS["requests_served"] / COALESCE_STATS["upstream_calls"], 2) if COALESCE_STATS["upstream_calls"] else 0,
+            "budget_used_this_minute": upstream_budget_used(),
+            "budget_per_minute": COINGECKO_CALLS_PER_MINUTE
+        },
+        "price_series": {"coins": len(SERIES), "max_coins": SERIES_MAX_COINS, "points_per_coin": SERIES_POINTS},
+        "price_stream": {**STREAM_STATS, "subscribers": len(STREAM_SUBSCRIBERS), "coins": len(STREAM_COINS)},
+        "startup": STARTUP,
+        "shared_state": {**SHARED_STATS, "enabled": SHARED_STATE, "worker_id": WORKER_ID},
+        "event_log": {**EVENT_LOG_STATE, "queue_depth": len(EVENT_QUEUE), "queue_max": EVENT_QUEUE_MAX},
         "circuits": {k: "OPEN" if v["open"] else "CLOSED" for k, v in CIRCUIT_STATE.items()}
     }
 
@@ -0,0 +1,381 @@
+"""Load and latency benchmark for app.py against local upstream stand-ins.
+
+Starts stand-ins for CoinGecko simple/price, Bing result pages and arbitrary HTML pages,
+runs the app under uvicorn pointed at them, drives each scenario at each concurrency level
+and reports throughput plus p50/p95/p99 overall and per cache outcome. Results are saved as
+JSON so runs can be compared:
+
+    python bench.py --concurrency 1,16,64 --duration 10
+    python bench.py --scenarios prices_live,fetch_live --upstream-latency-ms 120 --error-rate 0.05
+    python bench.py --compare bench_results/before.json bench_results/after.json
+"""
+import argparse
+import asyncio
+import html
+import itertools
+import json
+import math
+import multiprocessing
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from collections import Counter
+from datetime import datetime
+
+import httpx
+import numpy as np
+import orjson
+import uvicorn
+from starlette.applications import Starlette
+from starlette.responses import HTMLResponse, JSONResponse, Response
+from starlette.routing import Route
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# stand-in behaviour; scenarios override it per run through POST /_config
+UPSTREAM = {"latency_ms": 50.0, "jitter_ms": 10.0, "error_rate": 0.0, "throttle_rate": 0.0, "page_kb": 32, "results": 10}
+UPSTREAM_DEFAULTS = dict(UPSTREAM)
+UPSTREAM_CALLS = Counter()
+PAGE_BODIES = {}
+
+async def upstream_failure():
+    """Sleep for the configured latency, then maybe answer with an injected 500 or 429."""
+    await asyncio.sleep(max(0.0, random.gauss(UPSTREAM["latency_ms"], UPSTREAM["jitter_ms"])) / 1000)
+    roll = random.random()
+    if roll < UPSTREAM["error_rate"]:
+        return Response("injected upstream error", status_code=500)
+    if roll < UPSTREAM["error_rate"] + UPSTREAM["throttle_rate"]:
+        return Response("rate limited", status_code=429, headers={"Retry-After": "1"})
+    return None
+
+async def coingecko_price(request):
+    UPSTREAM_CALLS["coingecko"] += 1
+    failure = await upstream_failure()
+    if failure:
+        return failure
+    now = time.time()
+    prices = {}
+    for i, coin in enumerate(request.query_params.get("ids", "").split(",")):
+        if coin:
+            prices[coin] = {"usd": round(100 + 10 * math.sin(now / 60 + i), 4), "usd_24h_change": round(math.cos(now / 60 + i), 4)}
+    return JSONResponse(prices)
+
+async def bing_search(request):
+    UPSTREAM_CALLS["search"] += 1
+    failure = await upstream_failure()
+    if failure:
+        return failure
+    query = html.escape(request.query_params.get("q", ""))
+    items = "".join(
+        f'<li class="b_algo"><h2><a href="https://example.com/{i}">{query} result {i}</a></h2>'
+        f'<div class="b_caption"><p>Snippet {i} about {query}.</p></div></li>'
+        for i in range(UPSTREAM["results"])
+    )
+    return HTMLResponse(f'<html><body><ol id="b_results">{items}</ol></body></html>')
+
+def page_body(kb):
+    body = PAGE_BODIES.get(kb)
+    if body is None:
+        paragraph = "<p>" + "Lorem ipsum dolor sit amet, consectetur adipiscing elit. " * 8 + "</p>\n"
+        table = "<table>" + "".join(f"<tr><td>row {i}</td><td>{i * 3}</td></tr>" for i in range(20)) + "</table>\n"
+        links = "".join(f'<a href="/page/link{i}">link {i}</a>\n' for i in range(30))
+        body = PAGE_BODIES[kb] = table + links + paragraph * max(1, kb * 1024 // len(paragraph))
+    return body
+
+async def html_page(request):
+    UPSTREAM_CALLS["fetch"] += 1
+    name = request.path_params["name"]
+    kb = int(request.query_params.get("kb", UPSTREAM["page_kb"]))
+    etag = f'"{name}-{kb}"'
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+    failure = await upstream_failure()
+    if failure:
+        return failure
+    page = f"<html><head><title>Page {html.escape(name)}</title></head><body>{page_body(kb)}</body></html>"
+    return HTMLResponse(page, headers={"ETag": etag})
+
+async def upstream_config(request):
+    overrides = await request.json()
+    UPSTREAM.clear()
+    UPSTREAM.update({**UPSTREAM_DEFAULTS, **overrides})
+    return JSONResponse(UPSTREAM)
+
+async def upstream_stats(request):
+    return JSONResponse(UPSTREAM_CALLS)
+
+def run_upstream(port, config):
+    UPSTREAM.update(config)
+    UPSTREAM_DEFAULTS.update(config)
+    upstream = Starlette(routes=[
+        Route("/api/v3/simple/price", coingecko_price),
+        Route("/search", bing_search),
+        Route("/page/{name}", html_page),
+        Route("/_config", upstream_config, methods=["POST"]),
+        Route("/_stats", upstream_stats),
+    ])
+    uvicorn.run(upstream, host="127.0.0.1", port=port, log_level="warning", access_log=False)
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def coin_chunks(prefix, count, size=100):
+    coins = [f"{prefix}{n}" for n in range(count)]
+    return [("/prices", {"coins": ",".join(coins[i:i + size])}) for i in range(0, count, size)]
+
+def build_scenarios(args, upstream_url):
+    """name -> {prime: [(path, params)], wait: seconds, upstream: overrides, request: i -> (path, params)}."""
+    page = f"{upstream_url}/page"
+    hot_coins = {"coins": "bitcoin,ethereum,solana"}
+    hot_page = {"url": f"{page}/hot?kb={args.page_kb}"}
+    scenarios = {
+        "health": {"request": lambda i: ("/health", None)},
+        "prices_hot": {"prime": [("/prices", hot_coins)], "request": lambda i: ("/prices", hot_coins)},
+        # more coins than L0 holds, so lookups mix L0 and L1 hits
+        "prices_spread": {
+            "prime": coin_chunks("spread", args.spread_keys),
+            "request": lambda i: ("/prices", {"coins": f"spread{random.randrange(args.spread_keys)}"})
+        },
+        "prices_live": {"request": lambda i: ("/prices", {"coins": f"live-{uuid.uuid4().hex[:12]}"})},
+        "prices_throttled": {
+            "upstream": {"throttle_rate": 0.2},
+            "request": lambda i: ("/prices", {"coins": f"live-{uuid.uuid4().hex[:12]}"})
+        },
+        "fetch_hot": {"prime": [("/fetch", hot_page)], "request": lambda i: ("/fetch", hot_page)},
+        "fetch_live": {"request": lambda i: ("/fetch", {"url": f"{page}/{uuid.uuid4().hex[:12]}?kb={args.page_kb}"})},
+        "fetch_large": {"request": lambda i: ("/fetch", {"url": f"{page}/{uuid.uuid4().hex[:12]}?kb={args.large_page_kb}"})},
+        "fetch_errors": {
+            "upstream": {"error_rate": 0.1},
+            "request": lambda i: ("/fetch", {"url": f"{page}/{uuid.uuid4().hex[:12]}?kb={args.page_kb}"})
+        },
+        "search_hot": {"prime": [("/search", {"q": "bitcoin price"})], "request": lambda i: ("/search", {"q": "bitcoin price"})},
+        "search_live": {"request": lambda i: ("/search", {"q": f"query {uuid.uuid4().hex[:12]}"})},
+    }
+    # every run gets its own key pool, primed and then left to pass PRICE_TTL
+    prefix = f"stale{uuid.uuid4().hex[:6]}-"
+    scenarios["prices_stale"] = {
+        "prime": coin_chunks(prefix, args.stale_keys),
+        "wait": args.price_ttl + 1,
+        "request": lambda i: ("/prices", {"coins": f"{prefix}{i % args.stale_keys}"})
+    }
+    return scenarios
+
+def classify(response):
+    if response.status_code != 200:
+        return f"http_{response.status_code}"
+    try:
+        body = orjson.loads(response.content)
+    except orjson.JSONDecodeError:
+        return "ok"
+    return body.get("_cache") or "ok"
+
+def latency_stats(seconds):
+    ms = np.asarray(seconds) * 1000
+    p50, p95, p99 = np.percentile(ms, [50, 95, 99])
+    return {
+        "count": int(ms.size),
+        "mean": round(float(ms.mean()), 3),
+        "p50": round(float(p50), 3),
+        "p95": round(float(p95), 3),
+        "p99": round(float(p99), 3),
+        "max": round(float(ms.max()), 3)
+    }
+
+async def drive(client, request, counter, concurrency, duration):
+    """Closed-loop load: `concurrency` callers issue requests back to back until the deadline."""
+    samples = []
+    deadline = time.perf_counter() + duration
+
+    async def caller():
+        while time.perf_counter() < deadline:
+            path, params = request(next(counter))
+            start = time.perf_counter()
+            try:
+                outcome = classify(await client.get(path, params=params))
+            except httpx.HTTPError as e:
+                outcome = f"client_{type(e).__name__}"
+            samples.append((outcome, time.perf_counter() - start))
+
+    started = time.perf_counter()
+    await asyncio.gather(*(caller() for _ in range(concurrency)))
+    return samples, time.perf_counter() - started
+
+async def run_scenario(name, scenario, concurrency, args, app_url, upstream_url):
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=app_url, limits=limits, timeout=30) as client, \
+            httpx.AsyncClient(base_url=upstream_url) as upstream:
+        await upstream.post("/_config", json=scenario.get("upstream", {}))
+        for path, params in scenario.get("prime", []):
+            await client.get(path, params=params)
+        # let the group commit land in L1 (and stale scenarios pass PRICE_TTL)
+        await asyncio.sleep(scenario.get("wait", 0.2))
+        # one counter across warm-up and measurement, so key pools are not reused
+        counter = itertools.count()
+        if args.warmup:
+            await drive(client, scenario["request"], counter, concurrency, args.warmup)
+        before = (await upstream.get("/_stats")).json()
+        samples, elapsed = await drive(client, scenario["request"], counter, concurrency, args.duration)
+        after = (await upstream.get("/_stats")).json()
+        await upstream.post("/_config", json={})
+
+    outcomes = {}
+    for outcome, seconds in samples:
+        outcomes.setdefault(outcome, []).append(seconds)
+    return {
+        "scenario": name,
+        "concurrency": concurrency,
+        "requests": len(samples),
+        "duration_s": round(elapsed, 3),
+        "throughput_rps": round(len(samples) / elapsed, 2),
+        "latency_ms": latency_stats([seconds for _, seconds in samples]),
+        "outcomes": {outcome: latency_stats(seconds) for outcome, seconds in sorted(outcomes.items())},
+        "upstream_calls": {k: after[k] - before.get(k, 0) for k in after if after[k] != before.get(k, 0)},
+        "upstream": {**UPSTREAM_DEFAULTS, **scenario.get("upstream", {})}
+    }
+
+def start_app(args, port, upstream_url, workdir):
+    env = {
+        **os.environ,
+        "COINGECKO_URL": f"{upstream_url}/api/v3/simple/price",
+        "BING_URL": f"{upstream_url}/search",
+        "RATE_LIMIT_PRICES": "10000000/minute",
+        "RATE_LIMIT_FETCH": "10000000/minute",
+        "RATE_LIMIT_SEARCH": "10000000/minute",
+        "COINGECKO_CALLS_PER_MINUTE": "10000000",
+        "PRICE_TTL": str(args.price_ttl),
+        "L0_TTL": str(args.price_ttl),
+        "WEB_CONCURRENCY": str(args.workers),
+    }
+    log = open(os.path.join(workdir, "app.log"), "w")
+    command = [
+        sys.executable, "-m", "uvicorn", "app:app", "--app-dir", REPO_DIR,
+        "--host", "127.0.0.1", "--port", str(port), "--workers", str(args.workers),
+        "--log-level", "warning", "--no-access-log"
+    ]
+    return subprocess.Popen(command, cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+async def wait_ready(url, timeout=30):
+    deadline = time.time() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.time() < deadline:
+            try:
+                if (await client.get(url)).status_code == 200:
+                    return
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.1)
+    raise RuntimeError(f"{url} did not come up within {timeout}s")
+
+def git_revision():
+    try:
+        rev = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "app.py"], cwd=REPO_DIR, capture_output=True, text=True).stdout.strip()
+        return f"{rev}-dirty" if dirty else rev
+    except OSError:
+        return None
+
+def print_result(result):
+    lat = result["latency_ms"]
+    outcomes = ", ".join(f"{k}={v['count']} p99={v['p99']}ms" for k, v in result["outcomes"].items())
+    print(f"{result['scenario']:<17} c={result['concurrency']:<4} {result['throughput_rps']:>9.1f} rps  "
+          f"p50={lat['p50']:.2f} p95={lat['p95']:.2f} p99={lat['p99']:.2f} ms  [{outcomes}]  upstream={result['upstream_calls']}")
+
+async def run(args):
+    upstream_port, app_port = free_port(), free_port()
+    upstream_url, app_url = f"http://127.0.0.1:{upstream_port}", f"http://127.0.0.1:{app_port}"
+    upstream_config = {
+        "latency_ms": args.upstream_latency_ms, "jitter_ms": args.upstream_jitter_ms,
+        "error_rate": args.error_rate, "throttle_rate": args.throttle_rate, "page_kb": args.page_kb
+    }
+    UPSTREAM_DEFAULTS.update(upstream_config)
+    upstream = multiprocessing.Process(target=run_upstream, args=(upstream_port, upstream_config), daemon=True)
+    upstream.start()
+    workdir = tempfile.mkdtemp(prefix="sparky-bench-")
+    server = start_app(args, app_port, upstream_url, workdir)
+    results = []
+    try:
+        await wait_ready(f"{upstream_url}/_stats")
+        await wait_ready(f"{app_url}/health")
+        scenarios = build_scenarios(args, upstream_url)
+        names = args.scenarios.split(",") if args.scenarios else list(scenarios)
+        for name in names:
+            if name not in scenarios:
+                raise SystemExit(f"unknown scenario {name!r}; choose from {', '.join(scenarios)}")
+            for concurrency in args.concurrency:
+                # fresh key pools per run for scenarios that consume their keys
+                scenario = build_scenarios(args, upstream_url)[name]
+                result = await run_scenario(name, scenario, concurrency, args, app_url, upstream_url)
+                print_result(result)
+                results.append(result)
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+        upstream.terminate()
+
+    report = {
+        "meta": {
+            "started_at": datetime.utcnow().isoformat(),
+            "git_revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "app_log": os.path.join(workdir, "app.log"),
+            "args": {k: v for k, v in vars(args).items() if k != "compare"}
+        },
+        "results": results
+    }
+    out = args.out or os.path.join("bench_results", f"bench-{datetime.utcnow().strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(out) or ".", exist_ok=True)
+    with open(out, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"saved {out}")
+
+def compare(before_path, after_path):
+    """Throughput and latency change per (scenario, concurrency) between two saved runs."""
+    with open(before_path) as f:
+        before = {(r["scenario"], r["concurrency"]): r for r in json.load(f)["results"]}
+    with open(after_path) as f:
+        after = {(r["scenario"], r["concurrency"]): r for r in json.load(f)["results"]}
+    change = lambda old, new: f"{(new - old) / old * 100:+.1f}%" if old else "n/a"
+    print(f"{'scenario':<17} {'c':<5} {'rps':>20} {'p50 ms':>22} {'p99 ms':>22}")
+    for key in [k for k in after if k in before]:
+        b, a = before[key], after[key]
+        print(f"{key[0]:<17} {key[1]:<5} "
+              f"{b['throughput_rps']:>8.1f}->{a['throughput_rps']:<8.1f}{change(b['throughput_rps'], a['throughput_rps']):>4} "
+              f"{b['latency_ms']['p50']:>7.2f}->{a['latency_ms']['p50']:<7.2f}{change(b['latency_ms']['p50'], a['latency_ms']['p50']):>6} "
+              f"{b['latency_ms']['p99']:>7.2f}->{a['latency_ms']['p99']:<7.2f}{change(b['latency_ms']['p99'], a['latency_ms']['p99']):>6}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scenarios", help="comma-separated scenario names (default: all)")
+    parser.add_argument("--concurrency", type=lambda v: [int(c) for c in v.split(",")], default=[1, 16, 64])
+    parser.add_argument("--duration", type=float, default=10, help="measured seconds per scenario and concurrency level")
+    parser.add_argument("--warmup", type=float, default=1, help="unmeasured seconds before each run")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn workers for the app")
+    parser.add_argument("--upstream-latency-ms", type=float, default=50)
+    parser.add_argument("--upstream-jitter-ms", type=float, default=10)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of upstream calls answered with 500")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="fraction of upstream calls answered with 429")
+    parser.add_argument("--page-kb", type=int, default=32)
+    parser.add_argument("--large-page-kb", type=int, default=512)
+    parser.add_argument("--price-ttl", type=int, default=5, help="PRICE_TTL for the app; prices_stale waits this long")
+    parser.add_argument("--spread-keys", type=int, default=2000)
+    parser.add_argument("--stale-keys", type=int, default=5000)
+    parser.add_argument("--out", help="results file (default: bench_results/bench-<timestamp>.json)")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"), help="compare two saved results and exit")
+    args = parser.parse_args()
+    if args.compare:
+        compare(*args.compare)
+        return
+    asyncio.run(run(args))
+
+if __name__ == "__main__":
+    main()